@@ -7,7 +7,12 @@ from alembic import context
 
 from app.database import Base
 from app.config import settings
-from app.models import User, Message
+from app.models import (User,
+                        Message,
+                        MESSAGE_DEFAULT_PARTITION,
+                        MESSAGE_PARTITION_PREFIX,
+                        MESSAGE_SEARCH_COLUMN,
+                        MESSAGE_SEARCH_INDEX)
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -26,6 +31,24 @@ if config.config_file_name is not None:
 # target_metadata = mymodel.Base.metadata
 target_metadata = Base.metadata
 
+
+def include_object(object, name, type_, reflected, compare_to):
+    """Объекты, которые есть только в миграциях, а не в моделях."""
+
+    # Столбец и индекс полнотекстового поиска не объявлены в модели
+    if type_ == 'column' and name == MESSAGE_SEARCH_COLUMN:
+        return False
+    if type_ == 'index' and name == MESSAGE_SEARCH_INDEX:
+        return False
+    # Секции messages создаются миграцией и app.partitions
+    if type_ == 'table' and (
+        name.startswith(MESSAGE_PARTITION_PREFIX) or
+        name == MESSAGE_DEFAULT_PARTITION
+    ):
+        return False
+    return True
+
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -48,6 +71,7 @@ def run_migrations_offline() -> None:
     context.configure(
         url=url,
         target_metadata=target_metadata,
+        include_object=include_object,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
     )
@@ -71,7 +95,9 @@ def run_migrations_online() -> None:
 
     with connectable.connect() as connection:
         context.configure(
-            connection=connection, target_metadata=target_metadata
+            connection=connection,
+            target_metadata=target_metadata,
+            include_object=include_object
         )
 
         with context.begin_transaction():
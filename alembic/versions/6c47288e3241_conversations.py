@@ -0,0 +1,71 @@
+"""conversations
+
+Revision ID: 6c47288e3241
+Revises: a3f1c2d4e5b6
+Create Date: 2024-11-20 16:42:08.913274
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '6c47288e3241'
+down_revision: Union[str, None] = 'a3f1c2d4e5b6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'conversations',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('peer_id', sa.Integer(), nullable=False),
+        sa.Column('last_sender_id', sa.Integer(), nullable=False),
+        sa.Column('last_content', sa.String(), nullable=False),
+        sa.Column('last_message_at', sa.DateTime(), nullable=False),
+        sa.Column('unread_count', sa.Integer(), nullable=False),
+        sa.Column('read_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+        sa.ForeignKeyConstraint(['peer_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('user_id', 'peer_id')
+    )
+    op.create_index(
+        'ix_conversations_user_last_message',
+        'conversations',
+        ['user_id', 'last_message_at', 'peer_id'],
+        unique=False
+    )
+
+    # Сводки по уже сохраненным сообщениям: последнее сообщение каждой
+    # стороны диалога, прежние сообщения считаются прочитанными
+    op.execute(
+        """
+        INSERT INTO conversations (
+            user_id, peer_id, last_sender_id, last_content,
+            last_message_at, unread_count
+        )
+        SELECT DISTINCT ON (sides.user_id, sides.peer_id)
+            sides.user_id, sides.peer_id, m.sender_id, m.content,
+            m.created_at, 0
+        FROM messages m
+        CROSS JOIN LATERAL (
+            VALUES (m.sender_id, m.receiver_id), (m.receiver_id, m.sender_id)
+        ) AS sides (user_id, peer_id)
+        WHERE m.sender_id IS NOT NULL
+          AND m.receiver_id IS NOT NULL
+          AND m.content IS NOT NULL
+          AND m.created_at IS NOT NULL
+        ORDER BY sides.user_id, sides.peer_id, m.created_at DESC, m.id DESC
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(
+        'ix_conversations_user_last_message',
+        table_name='conversations'
+    )
+    op.drop_table('conversations')
@@ -0,0 +1,177 @@
+"""messages monthly partitions
+
+Revision ID: 8b1e5d7c9a20
+Revises: df46b4020b1b
+Create Date: 2024-12-03 10:27:19.604152
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from app.config import settings
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8b1e5d7c9a20'
+down_revision: Union[str, None] = 'df46b4020b1b'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# Секции по месяцам от первого сообщения на MESSAGES_PARTITIONS_AHEAD
+# месяцев вперед, как при обслуживании в app.partitions: строки месяцев
+# без секции попали бы в секцию по умолчанию, если фоновое обслуживание
+# не запущено. Дальнейшие секции создает app.partitions
+CREATE_PARTITIONS = """
+DO $$
+DECLARE
+    month date;
+    last_month date;
+BEGIN
+    SELECT
+        date_trunc('month', coalesce(min(created_at), timezone('utc', now()))),
+        greatest(
+            date_trunc('month', timezone('utc', now()))
+                + make_interval(months => {months_ahead}),
+            date_trunc('month', max(created_at))
+        )
+    INTO month, last_month
+    FROM messages_unpartitioned;
+
+    WHILE month <= last_month LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF messages '
+            'FOR VALUES FROM (%L) TO (%L)',
+            'messages_y' || to_char(month, 'YYYY"m"MM'),
+            month,
+            month + interval '1 month'
+        );
+        month := month + interval '1 month';
+    END LOOP;
+END
+$$
+"""
+
+
+def upgrade() -> None:
+    # Таблица переносится целиком под блокировкой: миграцию следует
+    # выполнять в окно обслуживания
+    op.rename_table('messages', 'messages_unpartitioned')
+    op.execute(
+        'ALTER TABLE messages_unpartitioned '
+        'RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey'
+    )
+    for index in (
+        'ix_messages_id',
+        'ix_messages_conversation',
+        'ix_messages_content_tsv',
+    ):
+        op.execute(f'ALTER INDEX {index} RENAME TO {index}_unpartitioned')
+
+    # Первичный ключ секционированной таблицы должен включать ключ
+    # секционирования
+    op.execute("""
+        CREATE TABLE messages (
+            id integer NOT NULL DEFAULT nextval('messages_id_seq'),
+            sender_id integer REFERENCES users (id),
+            receiver_id integer REFERENCES users (id),
+            content varchar,
+            created_at timestamp without time zone NOT NULL,
+            content_tsv tsvector GENERATED ALWAYS AS
+                (to_tsvector('russian'::regconfig, coalesce(content, '')))
+                STORED,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """)
+    op.execute('ALTER SEQUENCE messages_id_seq OWNED BY messages.id')
+    op.execute(CREATE_PARTITIONS.format(
+        months_ahead=settings.MESSAGES_PARTITIONS_AHEAD
+    ))
+    # Строки месяцев без секции (архивированных или еще не созданных)
+    # не отклоняются, app.partitions переносит их в месячные секции
+    op.execute('CREATE TABLE messages_default PARTITION OF messages DEFAULT')
+
+    op.execute("""
+        INSERT INTO messages (id, sender_id, receiver_id, content, created_at)
+        SELECT
+            id, sender_id, receiver_id, content,
+            coalesce(created_at, timezone('utc', now()))
+        FROM messages_unpartitioned
+    """)
+
+    op.create_index(
+        'ix_messages_conversation',
+        'messages',
+        [
+            sa.text('least(sender_id, receiver_id)'),
+            sa.text('greatest(sender_id, receiver_id)'),
+            'created_at',
+            'id',
+        ],
+        unique=False
+    )
+    op.create_index(
+        'ix_messages_content_tsv',
+        'messages',
+        ['content_tsv'],
+        unique=False,
+        postgresql_using='gin'
+    )
+    op.drop_table('messages_unpartitioned')
+
+
+def downgrade() -> None:
+    # Строки архивированных (удаленных) секций не восстанавливаются
+    op.rename_table('messages', 'messages_partitioned')
+    op.execute(
+        'ALTER INDEX ix_messages_conversation '
+        'RENAME TO ix_messages_conversation_partitioned'
+    )
+    op.execute(
+        'ALTER INDEX ix_messages_content_tsv '
+        'RENAME TO ix_messages_content_tsv_partitioned'
+    )
+
+    op.execute("""
+        CREATE TABLE messages (
+            id integer NOT NULL DEFAULT nextval('messages_id_seq'),
+            sender_id integer REFERENCES users (id),
+            receiver_id integer REFERENCES users (id),
+            content varchar,
+            created_at timestamp without time zone,
+            content_tsv tsvector GENERATED ALWAYS AS
+                (to_tsvector('russian'::regconfig, coalesce(content, '')))
+                STORED,
+            CONSTRAINT messages_pkey PRIMARY KEY (id)
+        )
+    """)
+    op.execute('ALTER SEQUENCE messages_id_seq OWNED BY messages.id')
+    op.execute("""
+        INSERT INTO messages (id, sender_id, receiver_id, content, created_at)
+        SELECT id, sender_id, receiver_id, content, created_at
+        FROM messages_partitioned
+    """)
+
+    op.create_index('ix_messages_id', 'messages', ['id'], unique=False)
+    op.create_index(
+        'ix_messages_conversation',
+        'messages',
+        [
+            sa.text('least(sender_id, receiver_id)'),
+            sa.text('greatest(sender_id, receiver_id)'),
+            'created_at',
+            'id',
+        ],
+        unique=False
+    )
+    op.create_index(
+        'ix_messages_content_tsv',
+        'messages',
+        ['content_tsv'],
+        unique=False,
+        postgresql_using='gin'
+    )
+    # Секции удаляются вместе с родительской таблицей
+    op.drop_table('messages_partitioned')
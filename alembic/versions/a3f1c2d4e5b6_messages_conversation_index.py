@@ -0,0 +1,36 @@
+"""messages conversation index
+
+Revision ID: a3f1c2d4e5b6
+Revises: 164515a8d03f
+Create Date: 2024-11-12 18:04:11.271903
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3f1c2d4e5b6'
+down_revision: Union[str, None] = '164515a8d03f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        'ix_messages_conversation',
+        'messages',
+        [
+            sa.text('least(sender_id, receiver_id)'),
+            sa.text('greatest(sender_id, receiver_id)'),
+            'created_at',
+            'id',
+        ],
+        unique=False
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_messages_conversation', table_name='messages')
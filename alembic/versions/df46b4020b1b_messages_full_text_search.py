@@ -0,0 +1,58 @@
+"""messages full text search
+
+Revision ID: df46b4020b1b
+Revises: 6c47288e3241
+Create Date: 2024-11-26 11:15:42.508316
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'df46b4020b1b'
+down_revision: Union[str, None] = '6c47288e3241'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Генерируемый столбец вычисляется в том же INSERT, что и сообщение,
+    # отдельного триггера или запроса при записи не требуется.
+    # Добавление столбца перезаписывает таблицу под блокировкой
+    op.add_column(
+        'messages',
+        sa.Column(
+            'content_tsv',
+            postgresql.TSVECTOR(),
+            sa.Computed(
+                "to_tsvector('russian'::regconfig, coalesce(content, ''))",
+                persisted=True
+            ),
+            nullable=True
+        )
+    )
+
+    # Индекс строится без блокировки записи сообщений
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_messages_content_tsv',
+            'messages',
+            ['content_tsv'],
+            unique=False,
+            postgresql_using='gin',
+            postgresql_concurrently=True
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            'ix_messages_content_tsv',
+            table_name='messages',
+            postgresql_concurrently=True
+        )
+    op.drop_column('messages', 'content_tsv')
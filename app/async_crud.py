@@ -0,0 +1,464 @@
+from datetime import datetime
+from sqlalchemy import (Row,
+                        func,
+                        insert,
+                        literal_column,
+                        or_,
+                        select,
+                        tuple_,
+                        update)
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from fastapi import Header, HTTPException, status
+
+from .models import (User,
+                     Message,
+                     Conversation,
+                     MESSAGE_SEARCH_COLUMN,
+                     MESSAGE_SEARCH_CONFIG)
+from .schemas import UserCreate, MessageBase, UserBase, ConversationBase
+from .auth import password_hasher
+from .utils import create_token
+from .conversations import (conversation_updates,
+                            select_read_markers,
+                            unread_keys,
+                            upsert_conversations)
+from .database import AsyncSessionLocal
+from .token_cache import token_cache
+from .users_version import users_version
+from .metrics import timed
+
+
+# Списки выбираются только нужными для ответа столбцами, без создания
+# объектов ORM и моделей pydantic на каждую строку
+MESSAGE_FIELDS = tuple(MessageBase.model_fields)
+MESSAGE_COLUMNS = tuple(getattr(Message, field) for field in MESSAGE_FIELDS)
+USER_FIELDS = tuple(UserBase.model_fields)
+USER_COLUMNS = tuple(getattr(User, field) for field in USER_FIELDS)
+MESSAGE_SEARCH_FIELDS = MESSAGE_FIELDS + ('snippet',)
+CONVERSATION_FIELDS = tuple(ConversationBase.model_fields)
+CONVERSATION_COLUMNS = tuple(
+    getattr(Conversation, field) for field in CONVERSATION_FIELDS
+)
+
+# Полнотекстовый поиск по сообщениям (столбец создается миграцией)
+SEARCH_CONFIG = literal_column(f"'{MESSAGE_SEARCH_CONFIG}'::regconfig")
+SEARCH_VECTOR = literal_column(
+    f'{Message.__tablename__}.{MESSAGE_SEARCH_COLUMN}', TSVECTOR
+)
+SEARCH_HEADLINE_OPTIONS = (
+    'StartSel=<mark>, StopSel=</mark>, MaxWords=20, MinWords=5, '
+    'MaxFragments=2, FragmentDelimiter=" … "'
+)
+# Замены для экранирования HTML в тексте фрагмента (& - первым)
+HTML_ESCAPES = (
+    ('&', '&amp;'),
+    ('<', '&lt;'),
+    ('>', '&gt;'),
+    ('"', '&quot;'),
+    ("'", '&#39;'),
+)
+
+
+def html_escape(text_column):
+    """Экранирование HTML на стороне базы данных."""
+
+    for char, escaped in HTML_ESCAPES:
+        text_column = func.replace(text_column, char, escaped)
+    return text_column
+
+
+@timed
+async def create_user(db: AsyncSession, user: UserCreate) -> User:
+    """Создание пользователя."""
+
+    # Хеширование пароля
+    hashed_password = await password_hasher.hash(user.password)
+    auth_token = create_token()
+
+    new_user = User(
+        username=user.username,
+        hashed_password=hashed_password,
+        auth_token=auth_token,
+        tg_username=user.tg_username
+    )
+
+    db.add(new_user)
+    await db.commit()
+    await db.refresh(new_user)
+    await users_version.bump()
+    return new_user
+
+
+@timed
+async def update_user_token(db: AsyncSession, user: User) -> User:
+    """Обновление токена пользователя."""
+
+    old_auth_token = user.auth_token
+    new_auth_token = create_token()
+    user.auth_token = new_auth_token
+
+    await db.commit()
+    await db.refresh(user)
+    await token_cache.invalidate(old_auth_token)
+    return user
+
+
+@timed
+async def save_message(
+        db: AsyncSession,
+        sender_id: int,
+        receiver_id: int,
+        content: str
+    ) -> Message:
+    """Сохранение сообщения в базу данных."""
+
+    message = Message(
+        sender_id=sender_id,
+        receiver_id=receiver_id,
+        content=content,
+        created_at=datetime.utcnow()
+    )
+    db.add(message)
+    await _update_conversations(db, [{
+        'sender_id': sender_id,
+        'receiver_id': receiver_id,
+        'content': content,
+        'created_at': message.created_at,
+    }])
+    await db.commit()
+    await db.refresh(message)
+    return message
+
+
+@timed
+async def save_messages(
+        db: AsyncSession,
+        messages: List[Dict[str, Any]]
+    ) -> None:
+    """Пакетное сохранение сообщений одним многострочным INSERT.
+
+    Сводки диалогов обновляются в той же транзакции.
+    """
+
+    if not messages:
+        return
+
+    await db.execute(insert(Message), messages)
+    await _update_conversations(db, messages)
+    await db.commit()
+
+
+async def _update_conversations(
+        db: AsyncSession,
+        messages: List[Dict[str, Any]]
+    ):
+    read_markers = {}
+    keys = unread_keys(messages)
+    if keys:
+        result = await db.execute(select_read_markers(keys))
+        read_markers = {
+            (row.user_id, row.peer_id): row.read_at for row in result
+        }
+    await db.execute(upsert_conversations(
+        db.get_bind().dialect.name,
+        conversation_updates(messages, read_markers)
+    ))
+
+
+@timed
+async def get_conversations(
+        db: AsyncSession,
+        user_id: int,
+        limit: int = 50,
+        before: Optional[Tuple[datetime, int]] = None
+    ) -> List[Row]:
+    """Получение страницы диалогов пользователя.
+
+    Диалоги упорядочены от последнего активного, курсор before -
+    позиция (last_message_at, peer_id) последнего диалога предыдущей
+    страницы. Возвращаются строки с полями CONVERSATION_FIELDS.
+    """
+
+    query = select(*CONVERSATION_COLUMNS).where(
+        Conversation.user_id == user_id
+    )
+    if before is not None:
+        query = query.where(
+            tuple_(Conversation.last_message_at, Conversation.peer_id) <
+            tuple_(*before)
+        )
+    result = await db.execute(
+        query.order_by(
+            Conversation.last_message_at.desc(),
+            Conversation.peer_id.desc()
+        ).limit(limit)
+    )
+    return list(result)
+
+
+@timed
+async def mark_conversation_read(
+        db: AsyncSession,
+        user_id: int,
+        peer_id: int
+    ) -> bool:
+    """Отметка о прочтении диалога: сброс счетчика непрочитанных.
+
+    Возвращает False, если диалога нет.
+    """
+
+    result = await db.execute(
+        update(Conversation)
+        .where(
+            Conversation.user_id == user_id,
+            Conversation.peer_id == peer_id
+        )
+        .values(unread_count=0, read_at=datetime.utcnow())
+    )
+    await db.commit()
+    return result.rowcount > 0
+
+
+@timed
+async def get_messages_history(
+        db: AsyncSession,
+        first_user_id: int,
+        second_user_id: int,
+        limit: int = 50,
+        before: Optional[Tuple[datetime, int]] = None,
+        after: Optional[Tuple[datetime, int]] = None
+    ) -> List[Row]:
+    """Получение страницы истории сообщений двоих пользователей.
+
+    Семантика курсоров совпадает с crud.get_messages_history.
+    Возвращаются строки с полями MESSAGE_FIELDS и id сообщения
+    последним столбцом.
+    """
+
+    low_user_id, high_user_id = sorted((first_user_id, second_user_id))
+    position = tuple_(Message.created_at, Message.id)
+
+    query = select(*MESSAGE_COLUMNS, Message.id).where(
+        func.least(Message.sender_id, Message.receiver_id) == low_user_id,
+        func.greatest(Message.sender_id, Message.receiver_id) == high_user_id
+    )
+
+    if after is not None:
+        result = await db.execute(
+            query.where(
+                position > tuple_(*after),
+                Message.created_at >= after[0]
+            ).order_by(
+                Message.created_at.asc(), Message.id.asc()
+            ).limit(limit)
+        )
+        return list(result)
+
+    if before is not None:
+        query = query.where(
+            position < tuple_(*before),
+            Message.created_at <= before[0]
+        )
+
+    result = await db.execute(
+        query.order_by(
+            Message.created_at.desc(), Message.id.desc()
+        ).limit(limit)
+    )
+    messages_history = list(result)
+    messages_history.reverse()
+
+    return messages_history
+
+
+@timed
+async def search_messages(
+        db: AsyncSession,
+        user_id: int,
+        query_text: str,
+        peer_id: Optional[int] = None,
+        limit: int = 20,
+        before: Optional[Tuple[datetime, int]] = None
+    ) -> List[Row]:
+    """Полнотекстовый поиск по сообщениям диалогов пользователя.
+
+    Запрос задается в синтаксисе websearch_to_tsquery (слова, "фраза",
+    or, -исключение). Найденные сообщения упорядочены от новых к старым,
+    курсор before - позиция (created_at, id) последнего сообщения
+    предыдущей страницы. peer_id ограничивает поиск одним диалогом.
+
+    Возвращаются строки с полями MESSAGE_SEARCH_FIELDS и id сообщения
+    последним столбцом. Фрагменты snippet строятся только для сообщений
+    страницы по тексту с экранированным HTML, найденные слова выделяются
+    тегами <mark>: фрагмент безопасно выводить как HTML.
+    """
+
+    ts_query = func.websearch_to_tsquery(SEARCH_CONFIG, query_text)
+    conditions = [SEARCH_VECTOR.op('@@')(ts_query)]
+    if peer_id is None:
+        conditions.append(or_(
+            Message.sender_id == user_id,
+            Message.receiver_id == user_id
+        ))
+    else:
+        low_user_id, high_user_id = sorted((user_id, peer_id))
+        conditions += [
+            func.least(Message.sender_id, Message.receiver_id) == low_user_id,
+            func.greatest(Message.sender_id, Message.receiver_id) ==
+            high_user_id,
+        ]
+    if before is not None:
+        conditions += [
+            tuple_(Message.created_at, Message.id) < tuple_(*before),
+            Message.created_at <= before[0],
+        ]
+
+    page = (
+        select(*MESSAGE_COLUMNS, Message.id)
+        .where(*conditions)
+        .order_by(Message.created_at.desc(), Message.id.desc())
+        .limit(limit)
+        .subquery()
+    )
+    result = await db.execute(
+        select(
+            *(page.c[field] for field in MESSAGE_FIELDS),
+            func.ts_headline(
+                SEARCH_CONFIG,
+                html_escape(page.c.content),
+                ts_query,
+                SEARCH_HEADLINE_OPTIONS
+            ).label('snippet'),
+            page.c.id
+        ).order_by(page.c.created_at.desc(), page.c.id.desc())
+    )
+    return list(result)
+
+
+@timed
+async def get_current_user(authorization: str = Header(...)) -> User:
+    """Получение текущего пользователя.
+
+    Пользователь сначала ищется в кэше токенов, сессия базы данных
+    открывается только при промахе.
+    """
+
+    token = authorization.split(' ')[1]
+
+    async def load_user() -> Optional[User]:
+        async with AsyncSessionLocal() as db:
+            return await db.scalar(
+                select(User).where(User.auth_token == token)
+            )
+
+    user = await token_cache.get_or_load(token, load_user)
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail='Неверный токен'
+        )
+    return user
+
+
+@timed
+async def get_user_by_username(db: AsyncSession, username: str) -> User:
+    """Получение пользователя по имени."""
+
+    return await db.scalar(select(User).where(User.username == username))
+
+
+@timed
+async def get_user_by_tg_username(db: AsyncSession, tg_username: str) -> User:
+    """Получение пользователя по нику в телеграм."""
+
+    return await db.scalar(
+        select(User).where(User.tg_username == tg_username)
+    )
+
+
+@timed
+async def subscribe_user_to_tgbot(
+        db: AsyncSession,
+        user: User,
+        chat_id: int
+    ) -> User:
+    """Подписать пользователя на бота."""
+
+    user.is_subscribed_to_bot = True
+    user.tg_chat_id = chat_id
+    await db.commit()
+    await db.refresh(user)
+    await token_cache.invalidate(user.auth_token)
+    await users_version.bump()
+    return user
+
+
+def _users_query(
+        subscribed: Optional[bool],
+        username: Optional[str],
+        after: Optional[int]
+    ):
+    query = select(*USER_COLUMNS)
+    if subscribed is not None:
+        query = query.where(User.is_subscribed_to_bot == subscribed)
+    if username:
+        query = query.where(
+            User.username.startswith(username, autoescape=True)
+        )
+    if after is not None:
+        query = query.where(User.id > after)
+    return query.order_by(User.id)
+
+
+@timed
+async def get_users_page(
+        db: AsyncSession,
+        subscribed: Optional[bool] = None,
+        username: Optional[str] = None,
+        after: Optional[int] = None,
+        limit: int = 100
+    ) -> List[Row]:
+    """Получение страницы списка пользователей.
+
+    Пользователи упорядочены по id, курсор after - id последнего
+    пользователя предыдущей страницы. subscribed - фильтр по подписке
+    на бота, username - по началу имени пользователя.
+    """
+
+    result = await db.execute(
+        _users_query(subscribed, username, after).limit(limit)
+    )
+    return list(result)
+
+
+async def iter_users(
+        subscribed: Optional[bool] = None,
+        username: Optional[str] = None,
+        after: Optional[int] = None,
+        chunk_size: int = 1000
+    ) -> AsyncIterator[List[Row]]:
+    """Выборка всех подходящих пользователей порциями по chunk_size.
+
+    Каждая порция читается в отдельной короткой сессии, поэтому
+    медленный получатель потока не удерживает соединение с базой.
+    """
+
+    while True:
+        async with AsyncSessionLocal() as db:
+            users = await get_users_page(
+                db, subscribed, username, after, chunk_size
+            )
+        if users:
+            yield users
+        if len(users) < chunk_size:
+            return
+        after = users[-1].id
+
+
+@timed
+async def get_user_info_by_id(user_id: int, db: AsyncSession) -> User:
+    """Получение информации о пользователе по его id."""
+
+    return await db.scalar(select(User).where(User.id == user_id))
@@ -1,7 +1,17 @@
+import asyncio, os
+
+from concurrent.futures import ProcessPoolExecutor
 from passlib.context import CryptContext
+from typing import Optional, Tuple
+
+from .config import settings
 
 
-pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
+pwd_context = CryptContext(
+    schemes=['bcrypt'],
+    deprecated='auto',
+    bcrypt__rounds=settings.BCRYPT_ROUNDS
+)
 
 
 def get_hashed_password(password: str) -> str:
@@ -14,3 +24,88 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Проверка совпадения введенного пароля с хэшированным."""
 
     return pwd_context.verify(plain_password, hashed_password)
+
+
+def verify_and_update_password(
+        plain_password: str,
+        hashed_password: str
+    ) -> Tuple[bool, Optional[str]]:
+    """Проверка пароля и получение нового хэша.
+
+    Новый хэш возвращается, если сохраненный хэш создан с устаревшими
+    параметрами (например, другим числом раундов bcrypt).
+    """
+
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+
+class PasswordHasherBusy(RuntimeError):
+    """Превышено время ожидания свободного места в пуле хэширования."""
+
+
+class PasswordHasher:
+    """Хэширование и проверка паролей в пуле процессов.
+
+    bcrypt занимает процессор на сотни миллисекунд, поэтому вычисления
+    вынесены из event loop в отдельные процессы. Число одновременно
+    принятых задач ограничено max_concurrency, чтобы волна входов
+    не занимала все ресурсы в ущерб чату.
+    """
+
+    def __init__(
+            self,
+            workers: int,
+            max_concurrency: int,
+            queue_timeout: float
+        ):
+        self._workers = workers or os.cpu_count() or 1
+        self._max_concurrency = max_concurrency
+        self._queue_timeout = queue_timeout
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    async def hash(self, password: str) -> str:
+        """Хэширование пароля."""
+
+        return await self._run(get_hashed_password, password)
+
+    async def verify_and_update(
+            self,
+            plain_password: str,
+            hashed_password: str
+        ) -> Tuple[bool, Optional[str]]:
+        """Проверка пароля с получением нового хэша при необходимости."""
+
+        return await self._run(
+            verify_and_update_password, plain_password, hashed_password
+        )
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def _run(self, func, *args):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self._workers)
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+
+        try:
+            await asyncio.wait_for(
+                self._semaphore.acquire(), self._queue_timeout
+            )
+        except asyncio.TimeoutError:
+            raise PasswordHasherBusy('Сервис проверки паролей перегружен')
+
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+        finally:
+            self._semaphore.release()
+
+
+password_hasher = PasswordHasher(
+    workers=settings.PASSWORD_HASH_WORKERS,
+    max_concurrency=settings.PASSWORD_HASH_MAX_CONCURRENCY,
+    queue_timeout=settings.PASSWORD_HASH_QUEUE_TIMEOUT
+)
@@ -0,0 +1,351 @@
+import asyncio, logging
+
+from redis.asyncio import Redis
+from typing import Dict, Iterable, List
+
+from .protocol import dumps, loads
+from .utils import send_message
+from .websocket_manager import WebSocketPool
+
+
+logger = logging.getLogger(__name__)
+
+NODE_PREFIX = 'cluster:node:'
+PRESENCE_PREFIX = 'presence:'
+NODE_USERS_PREFIX = 'cluster:node_users:'
+
+# Экземпляры пользователя с признаком жизни; упавшие удаляются
+# из множества присутствия
+LIVE_NODES_SCRIPT = """
+local live = {}
+for _, node_id in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    if redis.call('EXISTS', ARGV[1] .. node_id) == 1 then
+        table.insert(live, node_id)
+    else
+        redis.call('SREM', KEYS[1], node_id)
+    end
+end
+return live
+"""
+
+# Число живых экземпляров для каждого множества присутствия
+LIVE_COUNTS_SCRIPT = """
+local counts = {}
+for index, key in ipairs(KEYS) do
+    local count = 0
+    for _, node_id in ipairs(redis.call('SMEMBERS', key)) do
+        if redis.call('EXISTS', ARGV[1] .. node_id) == 1 then
+            count = count + 1
+        end
+    end
+    counts[index] = count
+end
+return counts
+"""
+
+# Снятие пользователей экземпляра из таблицы присутствия. Без ARGV[4]
+# выполняется, только если у экземпляра нет признака жизни. Возвращает
+# пользователей, не подключенных больше ни к одному живому экземпляру.
+# Скрипт атомарен, поэтому их получает только один вызов
+PURGE_NODE_SCRIPT = """
+if ARGV[4] ~= '1' and redis.call('EXISTS', KEYS[2]) == 1 then
+    return {}
+end
+local offline = {}
+for _, user_id in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    local presence = ARGV[2] .. user_id
+    redis.call('SREM', presence, ARGV[1])
+    local online = false
+    for _, node_id in ipairs(redis.call('SMEMBERS', presence)) do
+        if redis.call('EXISTS', ARGV[3] .. node_id) == 1 then
+            online = true
+            break
+        end
+    end
+    if not online then
+        table.insert(offline, user_id)
+    end
+end
+redis.call('DEL', KEYS[1])
+return offline
+"""
+
+
+def node_key(node_id: str) -> str:
+    """Ключ признака жизни экземпляра приложения."""
+
+    return f'{NODE_PREFIX}{node_id}'
+
+
+class ClusterRouter:
+    """Доставка сообщений между экземплярами приложения через Redis.
+
+    Каждый экземпляр хранит в Redis, какие пользователи подключены к нему
+    (presence:{user_id} - множество экземпляров пользователя), и слушает
+    собственный канал cluster:deliver:{node_id}. Сообщение публикуется
+    в каналы экземпляров получателя, а те отправляют его в свои сокеты.
+    Обновления статусов рассылаются всем экземплярам через общий канал.
+
+    Присутствие учитывается только на экземплярах с признаком жизни
+    (cluster:node:{node_id}). Пользователи упавших экземпляров раз
+    в node_ttl секунд снимаются из таблицы присутствия с рассылкой
+    статуса offline, а экземпляр при запуске снимает оставшихся
+    от прошлого процесса с тем же node_id.
+    """
+
+    BROADCAST_CHANNEL = 'cluster:broadcast'
+
+    def __init__(
+            self,
+            redis: Redis,
+            websocket_pool: WebSocketPool,
+            node_id: str,
+            heartbeat_interval: float,
+            node_ttl: int
+        ):
+        self._redis = redis
+        self._pool = websocket_pool
+        self.node_id = node_id
+        self._heartbeat_interval = heartbeat_interval
+        self._node_ttl = node_ttl
+        self._node_key = node_key(node_id)
+        self._node_users_key = f'{NODE_USERS_PREFIX}{node_id}'
+        self._channel = f'cluster:deliver:{node_id}'
+        self._live_nodes = redis.register_script(LIVE_NODES_SCRIPT)
+        self._live_counts = redis.register_script(LIVE_COUNTS_SCRIPT)
+        self._purge_node = redis.register_script(PURGE_NODE_SCRIPT)
+        self._pubsub = None
+        self._tasks = []
+
+    async def start(self):
+        # Пользователи прошлого процесса с тем же node_id (перезапуск
+        # контейнера) к этому процессу не подключены
+        await self._purge(self.node_id, force=True)
+        await self._redis.set(self._node_key, 1, ex=self._node_ttl)
+        self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.subscribe(self._channel, self.BROADCAST_CHANNEL)
+        self._tasks = [
+            asyncio.create_task(self._listen()),
+            asyncio.create_task(self._heartbeat()),
+            asyncio.create_task(self._sweep()),
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        if self._pubsub is not None:
+            await self._pubsub.unsubscribe()
+            await self._pubsub.aclose()
+            self._pubsub = None
+
+        # Снятие всех пользователей экземпляра из таблицы присутствия
+        user_ids = await self._redis.smembers(self._node_users_key)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.srem(f'presence:{user_id.decode()}', self.node_id)
+            pipe.delete(self._node_users_key, self._node_key)
+            await pipe.execute()
+
+    async def register(self, user_id: int):
+        """Отметка о подключении пользователя к текущему экземпляру."""
+
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.sadd(f'presence:{user_id}', self.node_id)
+            pipe.sadd(self._node_users_key, user_id)
+            await pipe.execute()
+
+    async def unregister(self, user_id: int):
+        """Снятие отметки, если у пользователя не осталось сокетов.
+
+        Если пользователь не подключен и к другим экземплярам, они
+        получают статус offline.
+        """
+
+        if self._pool.is_online(user_id):
+            return
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.srem(f'presence:{user_id}', self.node_id)
+            pipe.srem(self._node_users_key, user_id)
+            await pipe.execute()
+        if not await self._get_live_nodes(user_id):
+            await self.notify_user_status(user_id, 'offline')
+
+    async def get_statuses(self, user_ids: Iterable[int]) -> Dict[int, str]:
+        """Текущие статусы пользователей по таблице присутствия."""
+
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        counts = await self._live_counts(
+            keys=[f'{PRESENCE_PREFIX}{user_id}' for user_id in user_ids],
+            args=[NODE_PREFIX]
+        )
+        return {
+            user_id: 'online' if count else 'offline'
+            for user_id, count in zip(user_ids, counts)
+        }
+
+    async def deliver(self, user_id: int, message: str) -> bool:
+        """Доставка сообщения во все подключения пользователя в кластере.
+
+        Возвращает False, если пользователь не подключен ни к одному
+        живому экземпляру.
+        """
+
+        delivered = False
+        if self._pool.is_online(user_id):
+            delivered = await send_message(user_id, message, self._pool)
+
+        remote_node_ids = [
+            node_id
+            for node_id in await self._get_live_nodes(user_id)
+            if node_id != self.node_id
+        ]
+        if not remote_node_ids:
+            return delivered
+
+        payload = dumps({
+            'type': 'deliver',
+            'user_id': user_id,
+            'message': message,
+        })
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for node_id in remote_node_ids:
+                pipe.publish(f'cluster:deliver:{node_id}', payload)
+            receivers = await pipe.execute()
+
+        # Экземпляры без подписчиков на канале (еще с признаком жизни)
+        # считаются упавшими
+        dead_node_ids = [
+            node_id
+            for node_id, count in zip(remote_node_ids, receivers)
+            if not count
+        ]
+        if dead_node_ids:
+            await self._redis.srem(f'presence:{user_id}', *dead_node_ids)
+
+        return delivered or len(dead_node_ids) < len(remote_node_ids)
+
+    async def notify_user_status(self, user_id: int, status: str):
+        """Рассылка статуса пользователя по всем экземплярам."""
+
+        await self._pool.notify_user_status(user_id, status)
+        await self.publish_status(user_id, status)
+
+    async def publish_status(self, user_id: int, status: str):
+        """Рассылка статуса пользователя другим экземплярам."""
+
+        await self._redis.publish(self.BROADCAST_CHANNEL, dumps({
+            'type': 'status',
+            'origin': self.node_id,
+            'user_id': user_id,
+            'status': status,
+        }))
+
+    async def _get_live_nodes(self, user_id: int) -> List[str]:
+        """Живые экземпляры, к которым подключен пользователь."""
+
+        node_ids = await self._live_nodes(
+            keys=[f'{PRESENCE_PREFIX}{user_id}'], args=[NODE_PREFIX]
+        )
+        return [node_id.decode() for node_id in node_ids]
+
+    async def _purge(self, node_id: str, force: bool = False):
+        """Снятие пользователей экземпляра из таблицы присутствия
+        и рассылка статуса offline отключившимся полностью."""
+
+        user_ids = await self._purge_node(
+            keys=[f'{NODE_USERS_PREFIX}{node_id}', node_key(node_id)],
+            args=[node_id, PRESENCE_PREFIX, NODE_PREFIX, int(force)]
+        )
+        for user_id in user_ids:
+            await self.notify_user_status(int(user_id), 'offline')
+        if user_ids:
+            logger.info(
+                'Пользователи упавшего экземпляра сняты',
+                extra={
+                    'event': 'cluster.node_purged',
+                    'node_id': node_id,
+                    'offline': len(user_ids),
+                }
+            )
+
+    async def _sweep(self):
+        """Периодическое снятие пользователей упавших экземпляров."""
+
+        while True:
+            await asyncio.sleep(self._node_ttl)
+            try:
+                async for key in self._redis.scan_iter(
+                    match=f'{NODE_USERS_PREFIX}*'
+                ):
+                    node_id = key.decode()[len(NODE_USERS_PREFIX):]
+                    if node_id == self.node_id:
+                        continue
+                    if not await self._redis.exists(node_key(node_id)):
+                        await self._purge(node_id)
+            except Exception as e:
+                logger.error(
+                    'Ошибка при снятии пользователей упавших экземпляров: %s',
+                    e, extra={'event': 'cluster.sweep_error'}
+                )
+
+    async def _restore_presence(self):
+        """Повторная регистрация пользователей экземпляра.
+
+        Если признак жизни истек (например, Redis был недоступен),
+        другие экземпляры могли снять пользователей экземпляра
+        и разослать им статус offline.
+        """
+
+        user_ids = list(self._pool.connections)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.set(self._node_key, 1, ex=self._node_ttl)
+            for user_id in user_ids:
+                pipe.sadd(f'presence:{user_id}', self.node_id)
+                pipe.sadd(self._node_users_key, user_id)
+            await pipe.execute()
+        for user_id in user_ids:
+            await self.notify_user_status(user_id, 'online')
+        logger.warning(
+            'Признак жизни экземпляра истек, присутствие восстановлено',
+            extra={'event': 'cluster.presence_restored', 'users': len(user_ids)}
+        )
+
+    async def _listen(self):
+        async for event in self._pubsub.listen():
+            try:
+                data = loads(event['data'])
+                if data['type'] == 'deliver':
+                    if self._pool.is_online(data['user_id']):
+                        await send_message(
+                            data['user_id'], data['message'], self._pool
+                        )
+                elif data['type'] == 'status':
+                    if data['origin'] != self.node_id:
+                        await self._pool.notify_user_status(
+                            data['user_id'], data['status']
+                        )
+            except Exception as e:
+                logger.error(
+                    'Ошибка при обработке события кластера: %s', e,
+                    extra={'event': 'cluster.event_error'}
+                )
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self._heartbeat_interval)
+            try:
+                refreshed = await self._redis.set(
+                    self._node_key, 1, ex=self._node_ttl, xx=True
+                )
+                if not refreshed:
+                    await self._restore_presence()
+            except Exception as e:
+                logger.error(
+                    'Ошибка при обновлении признака жизни узла: %s', e,
+                    extra={'event': 'cluster.heartbeat_error'}
+                )
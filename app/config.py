@@ -1,3 +1,7 @@
+import os, socket
+
+from pydantic import Field
+from typing import Dict, Optional
 from pydantic_settings import BaseSettings
 
 
@@ -10,6 +14,83 @@ class Settings(BaseSettings):
     POSTGRES_HOST: str
     POSTGRES_PORT: str
 
+    # Явные адреса базы данных вместо postgres (например, sqlite
+    # для нагрузочных тестов в CI)
+    DATABASE_URL: Optional[str] = None
+    ASYNC_DATABASE_URL: Optional[str] = None
+
+    # Параметры пула соединений асинхронного движка (запросы HTTP,
+    # запись сообщений). Подключения WebSocket не держат соединения
+    # с базой, поэтому размер пула не зависит от их числа
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: int = 30
+    DB_POOL_RECYCLE: int = 1800
+
+    # Пул синхронного движка используется вызовами crud из потоков
+    # (crud.offload), обработчики запросов работают через async_crud
+    SYNC_DB_POOL_SIZE: int = 8
+    SYNC_DB_MAX_OVERFLOW: int = 0
+
+    REDIS_URL: str = 'redis://redis:6379'
+
+    # Идентификатор экземпляра приложения, уникальный для каждого
+    # процесса (в том числе для воркеров uvicorn в одном контейнере)
+    NODE_ID: str = Field(
+        default_factory=lambda: f'{socket.gethostname()}-{os.getpid()}'
+    )
+    CLUSTER_HEARTBEAT_INTERVAL: float = 5
+    CLUSTER_NODE_TTL: int = 30
+
+    # Хэширование паролей
+    BCRYPT_ROUNDS: int = 12
+    PASSWORD_HASH_WORKERS: int = 0
+    PASSWORD_HASH_MAX_CONCURRENCY: int = 16
+    PASSWORD_HASH_QUEUE_TIMEOUT: float = 5
+
+    # Кэш пользователей по токену авторизации
+    AUTH_CACHE_SIZE: int = 10000
+    AUTH_CACHE_TTL: float = 60
+    AUTH_CACHE_SHARED_TTL: int = 600
+
+    # Рассылка статусов пользователей
+    PRESENCE_FLUSH_INTERVAL: float = 0.5
+    PRESENCE_MAX_SUBSCRIPTIONS: int = 1000
+    WS_SEND_TIMEOUT: float = 5
+
+    # Очереди исходящих кадров подключений
+    WS_QUEUE_MAX_SIZE: int = 1000
+    WS_QUEUE_HIGH_WATER: int = 200
+    WS_SLOW_CONSUMER_TIMEOUT: float = 10
+    WS_STATUS_POLICY: str = 'coalesce'
+
+    # Очередь сообщений для пользователей не в сети
+    UNSENT_REPLAY_CHUNK: int = 100
+    UNSENT_MAX_LEN: int = 10000
+    OFFLINE_EVENTS_MAX_LEN: int = 100000
+
+    # Отложенная пакетная запись сообщений
+    MESSAGE_BATCH_SIZE: int = 500
+    MESSAGE_FLUSH_INTERVAL: float = 0.05
+    MESSAGE_QUEUE_SIZE: int = 10000
+    MESSAGE_DEAD_LETTER_MAX_LEN: int = 100000
+    MESSAGE_RECOVERY_INTERVAL: float = 30
+
+    # Месячные секции таблицы messages: сколько месяцев создавать
+    # заранее, срок хранения в месяцах (0 - хранить все), каталог
+    # архивов отсоединенных секций и период обслуживания в секундах
+    MESSAGES_PARTITIONS_AHEAD: int = 3
+    MESSAGES_RETENTION_MONTHS: int = 0
+    MESSAGES_ARCHIVE_DIR: str = '/var/lib/chat/archive'
+    MESSAGES_PARTITIONS_INTERVAL: float = 3600
+
+    # Логирование: уровень, формат (json или text), размер очереди
+    # и доли записываемых событий, например {"ws.offline_message": 0.01}
+    LOG_LEVEL: str = 'INFO'
+    LOG_FORMAT: str = 'json'
+    LOG_QUEUE_SIZE: int = 10000
+    LOG_SAMPLE_RATES: Dict[str, float] = {}
+
     class Config:
         env_file = '.env'
 
@@ -17,10 +98,23 @@ class Settings(BaseSettings):
     def database_url(self) -> str:
         """Получение URL для подключения к базе данных."""
 
+        if self.DATABASE_URL:
+            return self.DATABASE_URL
         return (
             f'postgresql://{self.POSTGRES_USER}:{self.POSTGRES_PASS}'
             f'@{self.POSTGRES_HOST}:{self.POSTGRES_PORT}/{self.POSTGRES_NAME}'
         )
 
+    @property
+    def async_database_url(self) -> str:
+        """Получение URL для асинхронного подключения к базе данных."""
+
+        if self.ASYNC_DATABASE_URL:
+            return self.ASYNC_DATABASE_URL
+        return (
+            f'postgresql+asyncpg://{self.POSTGRES_USER}:{self.POSTGRES_PASS}'
+            f'@{self.POSTGRES_HOST}:{self.POSTGRES_PORT}/{self.POSTGRES_NAME}'
+        )
+
 
 settings = Settings()
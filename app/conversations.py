@@ -0,0 +1,123 @@
+from datetime import datetime
+from sqlalchemy import and_, case, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+from .models import Conversation
+
+
+def unread_keys(messages: Iterable[Dict[str, Any]]) -> List[Tuple[int, int]]:
+    """Диалоги (user_id, peer_id), в которые пакет добавляет входящие."""
+
+    return sorted({
+        (message['receiver_id'], message['sender_id'])
+        for message in messages
+        if message['receiver_id'] != message['sender_id']
+    })
+
+
+def select_read_markers(keys: List[Tuple[int, int]]):
+    """Отметки о прочтении диалогов с блокировкой строк до конца
+    транзакции: отметка не изменится до обновления счетчиков."""
+
+    return (
+        select(
+            Conversation.user_id,
+            Conversation.peer_id,
+            Conversation.read_at
+        )
+        .where(
+            tuple_(Conversation.user_id, Conversation.peer_id).in_(keys),
+            Conversation.read_at.is_not(None)
+        )
+        .order_by(Conversation.user_id, Conversation.peer_id)
+        .with_for_update()
+    )
+
+
+def conversation_updates(
+        messages: Iterable[Dict[str, Any]],
+        read_markers: Optional[Mapping[Tuple[int, int], datetime]] = None
+    ) -> List[Dict[str, Any]]:
+    """Изменения сводок диалогов по пакету сообщений.
+
+    Для каждого участника пары - последнее сообщение пакета и число
+    входящих сообщений, которые добавляются к непрочитанным. Сообщения,
+    отправленные не позже отметки о прочтении из read_markers, к ним
+    не относятся (пакет из журнала может прийти после прочтения).
+    """
+
+    read_markers = read_markers or {}
+
+    updates: Dict[Tuple[int, int], Dict[str, Any]] = {}
+    for message in messages:
+        sender_id = message['sender_id']
+        receiver_id = message['receiver_id']
+        sides = [(sender_id, receiver_id, 0)]
+        if receiver_id != sender_id:
+            sides.append((receiver_id, sender_id, 1))
+
+        for user_id, peer_id, unread in sides:
+            update = updates.get((user_id, peer_id))
+            if update is None:
+                update = updates[(user_id, peer_id)] = {
+                    'user_id': user_id,
+                    'peer_id': peer_id,
+                    'unread_count': 0,
+                }
+            if (
+                'last_message_at' not in update or
+                message['created_at'] >= update['last_message_at']
+            ):
+                update['last_sender_id'] = sender_id
+                update['last_content'] = message['content']
+                update['last_message_at'] = message['created_at']
+            read_at = read_markers.get((user_id, peer_id))
+            if read_at is None or message['created_at'] > read_at:
+                update['unread_count'] += unread
+
+    # Одинаковый порядок строк во всех экземплярах исключает взаимные
+    # блокировки при одновременном обновлении одних и тех же диалогов
+    return [updates[key] for key in sorted(updates)]
+
+
+def upsert_conversations(dialect_name: str, updates: List[Dict[str, Any]]):
+    """INSERT ... ON CONFLICT для сводок диалогов.
+
+    Последнее сообщение заменяется, только если оно новее сохраненного
+    (пакеты из журналов упавших экземпляров могут прийти позже).
+    Если все сообщения пакета отправлены не позже отметки о прочтении,
+    счетчик непрочитанных не меняется (точный учет отметки для
+    каждого сообщения - в conversation_updates с read_markers).
+    """
+
+    insert = sqlite.insert if dialect_name == 'sqlite' else postgresql.insert
+    statement = insert(Conversation).values(updates)
+    excluded = statement.excluded
+    is_newer = excluded.last_message_at >= Conversation.last_message_at
+    is_read = and_(
+        Conversation.read_at.is_not(None),
+        excluded.last_message_at <= Conversation.read_at
+    )
+
+    return statement.on_conflict_do_update(
+        index_elements=[Conversation.user_id, Conversation.peer_id],
+        set_={
+            'last_sender_id': case(
+                (is_newer, excluded.last_sender_id),
+                else_=Conversation.last_sender_id
+            ),
+            'last_content': case(
+                (is_newer, excluded.last_content),
+                else_=Conversation.last_content
+            ),
+            'last_message_at': case(
+                (is_newer, excluded.last_message_at),
+                else_=Conversation.last_message_at
+            ),
+            'unread_count': case(
+                (is_read, Conversation.unread_count),
+                else_=Conversation.unread_count + excluded.unread_count
+            ),
+        }
+    )
@@ -1,14 +1,20 @@
-import concurrent.futures
+import asyncio, time
 
+from datetime import datetime
+from sqlalchemy import func, tuple_
 from sqlalchemy.orm import Session
-from typing import List
+from typing import Callable, List, Optional, Tuple, TypeVar
 from fastapi import Header, Depends, HTTPException, status
 
 from .models import User, Message
 from .schemas import UserCreate
 from .auth import get_hashed_password
 from .utils import create_token
-from .database import get_db
+from .database import get_db, SessionLocal
+from .metrics import DB_QUERY_DURATION
+
+
+T = TypeVar('T')
 
 
 def create_user(db: Session, user: UserCreate) -> User:
@@ -42,47 +48,50 @@ def update_user_token(db: Session, user: User) -> User:
     return user
 
 
-def save_message(
-        db: Session,
-        sender_id: int,
-        receiver_id: int,
-        content: str
-    ) -> Message:
-    """Сохранение сообщения в базу данных."""
-
-    def save_to_db():
-
-        message = Message(
-            sender_id=sender_id,
-            receiver_id=receiver_id,
-            content=content
-        )
-        db.add(message)
-        db.commit()
-        db.refresh(message)
-        return message
-
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future = executor.submit(save_to_db)
-        return future.result()
-
-
 def get_messages_history(
         db: Session,
         first_user_id: int,
-        second_user_id: int
+        second_user_id: int,
+        limit: int = 50,
+        before: Optional[Tuple[datetime, int]] = None,
+        after: Optional[Tuple[datetime, int]] = None
     ) -> List[Message]:
-    """Получение истории сообщений двоих пользователей."""
-
-    messages_history = db.query(Message).filter(
-        (
-            (Message.sender_id == first_user_id) &
-            (Message.receiver_id == second_user_id)
-        ) |
-        (
-            (Message.sender_id == second_user_id) &
-            (Message.receiver_id == first_user_id)
-        )).order_by(Message.created_at.asc()).all()
+    """Получение страницы истории сообщений двоих пользователей.
+
+    Страница задается курсором (created_at, id): before - сообщения
+    старше курсора, after - новее. Без курсора возвращаются последние
+    сообщения. Результат всегда упорядочен от старых к новым.
+
+    Условие на created_at дублирует сравнение курсора: по сравнению
+    кортежей postgres не отсекает месячные секции таблицы.
+    """
+
+    low_user_id, high_user_id = sorted((first_user_id, second_user_id))
+    position = tuple_(Message.created_at, Message.id)
+
+    query = db.query(Message).filter(
+        func.least(Message.sender_id, Message.receiver_id) == low_user_id,
+        func.greatest(Message.sender_id, Message.receiver_id) == high_user_id
+    )
+
+    if after is not None:
+        return query.filter(
+            position > tuple_(*after),
+            Message.created_at >= after[0]
+        ).order_by(
+            Message.created_at.asc(), Message.id.asc()
+        ).limit(limit).all()
+
+    if before is not None:
+        query = query.filter(
+            position < tuple_(*before),
+            Message.created_at <= before[0]
+        )
+
+    messages_history = query.order_by(
+        Message.created_at.desc(), Message.id.desc()
+    ).limit(limit).all()
+    messages_history.reverse()
 
     return messages_history
 
@@ -103,7 +112,7 @@ def get_current_user(
     return user
 
 
-async def get_user_by_tg_username(db: Session, tg_username: str) -> User:
+def get_user_by_tg_username(db: Session, tg_username: str) -> User:
     """Получение пользователя по нику в телеграм."""
 
     user = db.query(User).filter(User.tg_username == tg_username).first()
@@ -123,26 +132,40 @@ def subscribe_user_to_tgbot(db: Session, user: User, chat_id: int) -> User:
 def get_subscribed_users(db: Session) -> List[User]:
     """Получить список пользователей, подписанных на бота."""
 
-    def query_subscribed_users(db: Session) -> List[User]:
-        return db.query(User).filter(User.is_subscribed_to_bot == True).all()
-
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future = executor.submit(query_subscribed_users, db)
-        return future.result()
+    return db.query(User).filter(User.is_subscribed_to_bot == True).all()
 
 
 def get_all_users(db: Session) -> List[User]:
     """Получить список всех пользователей."""
 
-    def query_all_users(db: Session) -> List[User]:
-        return db.query(User).all()
-
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future = executor.submit(query_all_users, db)
-        return future.result()
+    return db.query(User).all()
 
 
 def get_user_info_by_id(user_id: int, db: Session) -> User:
     """Получение информации о пользователе по его id."""
 
     return db.query(User).filter(User.id == user_id).first()
+
+
+def _call_with_session(func: Callable[..., T], *args, **kwargs) -> T:
+    """Вызов функции crud с собственной сессией текущего потока."""
+
+    started_at = time.perf_counter()
+    try:
+        with SessionLocal() as db:
+            return func(db, *args, **kwargs)
+    finally:
+        DB_QUERY_DURATION.labels(func.__name__).observe(
+            time.perf_counter() - started_at
+        )
+
+
+async def offload(func: Callable[..., T], *args, **kwargs) -> T:
+    """Выполнение синхронной функции crud в пуле потоков event loop.
+
+    Сессия передается функции первым аргументом: каждый вызов получает
+    отдельную сессию, которая закрывается по завершении, поэтому сессии
+    не разделяются между потоками.
+    """
+
+    return await asyncio.to_thread(_call_with_session, func, *args, **kwargs)
@@ -1,14 +1,49 @@
+import redis.asyncio as aioredis
+
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from .config import settings
+from .metrics import instrument_pool, instrument_redis
 
 
-engine = create_engine(settings.database_url)
+engine = create_engine(
+    settings.database_url,
+    pool_size=settings.SYNC_DB_POOL_SIZE,
+    max_overflow=settings.SYNC_DB_MAX_OVERFLOW,
+    pool_timeout=settings.DB_POOL_TIMEOUT,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+    pool_pre_ping=True
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# Класс пула задан явно: для sqlite (стенд нагрузочных тестов)
+# по умолчанию пул не используется
+async_engine = create_async_engine(
+    settings.async_database_url,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_timeout=settings.DB_POOL_TIMEOUT,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+    pool_pre_ping=True
+)
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine,
+    autoflush=False,
+    expire_on_commit=False
+)
+
+redis_client = aioredis.from_url(settings.REDIS_URL)
+
+instrument_pool(engine.pool, 'sync')
+instrument_pool(async_engine.sync_engine.pool, 'async')
+instrument_redis(redis_client)
+
 
 def get_db():
     db = SessionLocal()
@@ -16,3 +51,8 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -0,0 +1,124 @@
+import logging, orjson, queue, random, sys
+
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+from .config import settings
+
+
+# Атрибуты LogRecord, которые не считаются полями события
+RESERVED_ATTRS = frozenset(
+    logging.LogRecord('', 0, '', 0, '', (), None).__dict__
+) | {'message', 'asctime'}
+
+
+class SamplingFilter(logging.Filter):
+    """Пропуск доли записей для событий с заданной частотой.
+
+    Имя события передается в extra={'event': ...}. Записи уровня
+    WARNING и выше пропускаются всегда.
+    """
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self._rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rates.get(getattr(record, 'event', None))
+        return rate is None or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись в одну строку JSON со всеми полями из extra."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in RESERVED_ATTRS:
+                data[key] = value
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return orjson.dumps(data, default=str).decode()
+
+
+class TextFormatter(logging.Formatter):
+    """Читаемый формат с полями из extra в виде key=value."""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s %(message)s')
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = ' '.join(
+            f'{key}={value}'
+            for key, value in record.__dict__.items()
+            if key not in RESERVED_ATTRS
+        )
+        return f'{line} {fields}' if fields else line
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Постановка записей в ограниченную очередь без ожидания.
+
+    Запись и форматирование выполняет отдельный поток, поэтому event
+    loop не блокируется на выводе. При переполнении очереди записи
+    отбрасываются и подсчитываются.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Форматирование сообщения откладывается до потока записи
+        return record
+
+
+_listener: Optional[QueueListener] = None
+
+
+def configure_logging():
+    """Настройка логгеров приложения по параметрам из settings."""
+
+    global _listener
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(
+        JsonFormatter() if settings.LOG_FORMAT == 'json' else TextFormatter()
+    )
+
+    log_queue = queue.Queue(settings.LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(settings.LOG_SAMPLE_RATES))
+
+    logger = logging.getLogger('app')
+    logger.setLevel(settings.LOG_LEVEL)
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+
+    _listener = QueueListener(log_queue, stream_handler)
+    _listener.start()
+
+
+def stop_logging():
+    """Запись оставшихся в очереди записей и остановка потока."""
+
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,10 +1,79 @@
-from fastapi import FastAPI
+import time
+
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from .database import async_engine, engine
+from .log import configure_logging, stop_logging
+from .metrics import (HTTP_REQUEST_DURATION,
+                      pool_stats,
+                      render_metrics,
+                      stats_collector)
+from .auth import password_hasher
+from .partitions import partition_manager
+from .token_cache import token_cache
+from .routers import (http_router,
+                      ws_router,
+                      message_writer,
+                      cluster,
+                      websocket_pool)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Запуск и остановка фоновых ресурсов приложения."""
+
+    await token_cache.start()
+    await websocket_pool.start()
+    # Журнал прошлого запуска переносится до регистрации экземпляра
+    await message_writer.start()
+    await cluster.start()
+    await partition_manager.start()
+    yield
+    await partition_manager.stop()
+    await message_writer.stop()
+    await cluster.stop()
+    await websocket_pool.stop()
+    await token_cache.stop()
+    await async_engine.dispose()
+    password_hasher.shutdown()
+    stop_logging()
+
+
+configure_logging()
+stats_collector.add('websocket_pool', websocket_pool.stats)
+stats_collector.add('token_cache', token_cache.stats)
+stats_collector.add('db_pool_async', lambda: pool_stats(async_engine.pool))
+stats_collector.add('db_pool_sync', lambda: pool_stats(engine.pool))
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware('http')
+async def observe_request_duration(request: Request, call_next):
+    """Замер времени обработки запроса по шаблону маршрута."""
+
+    started_at = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        route = request.scope.get('route')
+        HTTP_REQUEST_DURATION.labels(
+            request.method,
+            route.path if route is not None else 'unmatched',
+            status_code
+        ).observe(time.perf_counter() - started_at)
 
-from .routers import http_router, ws_router
 
+@app.get('/metrics', include_in_schema=False)
+async def metrics():
+    return Response(render_metrics(), media_type=CONTENT_TYPE_LATEST)
 
-app = FastAPI()
 
 app.include_router(http_router)
 app.include_router(ws_router)
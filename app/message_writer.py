@@ -0,0 +1,333 @@
+import asyncio, json, logging, time
+
+from datetime import datetime
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+from sqlalchemy.exc import InterfaceError, OperationalError
+from typing import Any, Dict, List, Optional, Tuple
+
+from .async_crud import save_messages
+from .cluster import node_key
+from .config import settings
+from .database import AsyncSessionLocal
+
+
+logger = logging.getLogger(__name__)
+
+# Ошибки, после которых тот же пакет можно записать повторно (база
+# недоступна, соединение разорвано). Прочие ошибки относятся
+# к содержимому пакета
+TRANSIENT_ERRORS = (
+    InterfaceError,
+    OperationalError,
+    OSError,
+    asyncio.TimeoutError,
+)
+
+
+class MessageWriter:
+    """Отложенная пакетная запись сообщений в базу данных.
+
+    Сообщение сначала записывается в журнал (Redis stream), после чего
+    считается принятым, и попадает в ограниченную очередь в памяти.
+    Фоновая задача забирает сообщения из очереди пакетами по размеру
+    или по истечении интервала, сохраняет их одним INSERT и удаляет
+    из журнала. Записи, оставшиеся в журнале экземпляра с прошлого
+    запуска, досохраняются при его запуске, журналы упавших экземпляров
+    (без признака жизни в Redis) - периодически любым другим экземпляром.
+
+    Сообщения, которые база отклоняет (например, несуществующий
+    получатель), переносятся из журнала в поток messages:dead_letter
+    с текстом ошибки и не задерживают запись остальных.
+    """
+
+    JOURNAL_PREFIX = 'messages:journal:'
+    RECOVERY_SUFFIX = ':recovering'
+    DEAD_LETTER_KEY = 'messages:dead_letter'
+
+    def __init__(
+            self,
+            redis: Redis,
+            batch_size: int,
+            flush_interval: float,
+            max_queue_size: int,
+            dead_letter_max_len: int,
+            recovery_interval: float
+        ):
+        self._redis = redis
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue_size)
+        self._dead_letter_max_len = dead_letter_max_len
+        self._recovery_interval = recovery_interval
+        self._journal_key = f'{self.JOURNAL_PREFIX}{settings.NODE_ID}'
+        # Журнал, который досохраняет экземпляр. Ключ с тем же префиксом,
+        # что и журналы, заберет другой экземпляр, если этот упадет
+        self._recovery_key = f'{self._journal_key}{self.RECOVERY_SUFFIX}'
+        self._task: Optional[asyncio.Task] = None
+        self._recovery_task: Optional[asyncio.Task] = None
+        self._closing = False
+        self._stopping = asyncio.Event()
+
+    @property
+    def queue_size(self) -> int:
+        return self._queue.qsize()
+
+    async def start(self):
+        """Перенос записей журнала прошлого запуска и запуск фоновой записи.
+
+        Вызывается до регистрации признака жизни экземпляра: NODE_ID
+        может совпадать с NODE_ID прошлого запуска (тот же контейнер),
+        и его журнал не должен считаться журналом живого экземпляра.
+        """
+
+        self._closing = False
+        self._stopping.clear()
+        # Незавершенное восстановление прошлого запуска: ключ должен
+        # освободиться до переноса в него собственного журнала
+        await self._replay(self._recovery_key)
+        await self._claim(self._journal_key)
+        self._task = asyncio.create_task(self._run())
+        self._recovery_task = asyncio.create_task(
+            self._recover_periodically()
+        )
+
+    async def stop(self):
+        """Запись всех принятых сообщений и остановка."""
+
+        if self._task is None:
+            return
+        # Восстановление завершается после записи текущего пакета
+        self._closing = True
+        self._stopping.set()
+        await self._recovery_task
+        self._recovery_task = None
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def submit(
+            self,
+            sender_id: int,
+            receiver_id: int,
+            content: str
+        ) -> datetime:
+        """Прием сообщения на запись.
+
+        Если очередь заполнена, вызов ждет освобождения места.
+        """
+
+        if self._closing:
+            raise RuntimeError('Запись сообщений остановлена')
+
+        message = {
+            'sender_id': sender_id,
+            'receiver_id': receiver_id,
+            'content': content,
+            'created_at': datetime.utcnow(),
+        }
+        entry_id = await self._redis.xadd(
+            self._journal_key,
+            {'data': self._dump(message)}
+        )
+        await self._queue.put((entry_id, message))
+        return message['created_at']
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            deadline = loop.time() + self._flush_interval
+            while len(batch) < self._batch_size:
+                try:
+                    if self._queue.empty():
+                        timeout = deadline - loop.time()
+                        if timeout <= 0:
+                            break
+                        item = await asyncio.wait_for(
+                            self._queue.get(), timeout
+                        )
+                    else:
+                        item = self._queue.get_nowait()
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self._flush(batch, self._journal_key)
+
+    async def _flush(
+            self,
+            batch: List[Tuple[Any, Dict[str, Any]]],
+            journal_key: str
+        ):
+        """Запись пакета с повторными попытками.
+
+        Повторяются только попытки после временных ошибок. Если база
+        отклоняет пакет, он делится пополам до выделения сообщений,
+        которые не удается записать, - они переносятся в поток
+        DEAD_LETTER_KEY. При остановке пакет, не записанный из-за
+        временной ошибки, остается в журнале и будет записан другим
+        экземпляром.
+        """
+
+        delay = 0.1
+        started_at = time.perf_counter()
+        while True:
+            try:
+                async with AsyncSessionLocal() as db:
+                    await save_messages(db, [message for _, message in batch])
+                break
+            except TRANSIENT_ERRORS as e:
+                logger.error(
+                    'Ошибка при записи пакета сообщений: %s', e,
+                    extra={'event': 'writer.flush_error', 'size': len(batch)}
+                )
+                if self._closing:
+                    return
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5)
+            except Exception as e:
+                if len(batch) == 1:
+                    await self._dead_letter(batch[0], journal_key, e)
+                    return
+                middle = len(batch) // 2
+                await self._flush(batch[:middle], journal_key)
+                await self._flush(batch[middle:], journal_key)
+                return
+
+        await self._redis.xdel(
+            journal_key,
+            *[entry_id for entry_id, _ in batch]
+        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Пакет сообщений записан', extra={
+                'event': 'writer.flush',
+                'size': len(batch),
+                'latency_ms': (time.perf_counter() - started_at) * 1000,
+            })
+
+    async def _dead_letter(
+            self,
+            item: Tuple[Any, Dict[str, Any]],
+            journal_key: str,
+            error: Exception
+        ):
+        """Перенос отклоненного базой сообщения из журнала."""
+
+        entry_id, message = item
+        logger.error(
+            'Сообщение отклонено базой данных: %s', error,
+            extra={
+                'event': 'writer.dead_letter',
+                'sender_id': message.get('sender_id'),
+                'receiver_id': message.get('receiver_id'),
+            }
+        )
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.xadd(
+                self.DEAD_LETTER_KEY,
+                {
+                    'data': json.dumps(message, default=str),
+                    'error': str(error),
+                    'journal': journal_key,
+                },
+                maxlen=self._dead_letter_max_len,
+                approximate=True
+            )
+            pipe.xdel(journal_key, entry_id)
+            await pipe.execute()
+
+    async def _recover_periodically(self):
+        while not self._closing:
+            try:
+                await self._recover()
+            except Exception as e:
+                logger.error(
+                    'Ошибка при восстановлении журналов сообщений: %s', e,
+                    extra={'event': 'writer.recovery_error'}
+                )
+            try:
+                await asyncio.wait_for(
+                    self._stopping.wait(), self._recovery_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    async def _recover(self):
+        """Запись сообщений из журналов упавших экземпляров."""
+
+        # Журнал, перенесенный при запуске или в прошлом проходе
+        await self._replay(self._recovery_key)
+
+        async for key in self._redis.scan_iter(
+            match=f'{self.JOURNAL_PREFIX}*'
+        ):
+            if self._closing:
+                return
+            key = key.decode()
+            if key in (self._journal_key, self._recovery_key):
+                continue
+            node_id = key[len(self.JOURNAL_PREFIX):]
+            if node_id.endswith(self.RECOVERY_SUFFIX):
+                node_id = node_id[:-len(self.RECOVERY_SUFFIX)]
+            if await self._redis.exists(node_key(node_id)):
+                continue
+
+            if await self._claim(key):
+                await self._replay(self._recovery_key)
+
+    async def _claim(self, key: str) -> bool:
+        """Перенос журнала в ключ восстановления экземпляра.
+
+        RENAMENX атомарен: журнал забирает только один экземпляр,
+        а ключ восстановления не перезаписывается.
+        """
+
+        try:
+            claimed = await self._redis.renamenx(key, self._recovery_key)
+        except ResponseError:
+            # Журнала уже нет
+            return False
+        if claimed:
+            logger.info('Журнал сообщений перенесен на запись', extra={
+                'event': 'writer.recover',
+                'journal': key,
+            })
+        return bool(claimed)
+
+    async def _replay(self, journal_key: str):
+        while not self._closing:
+            entries = await self._redis.xrange(
+                journal_key, count=self._batch_size
+            )
+            if not entries:
+                await self._redis.delete(journal_key)
+                return
+            await self._flush(
+                [
+                    (entry_id, self._load(fields[b'data']))
+                    for entry_id, fields in entries
+                ],
+                journal_key
+            )
+
+    @staticmethod
+    def _dump(message: Dict[str, Any]) -> str:
+        return json.dumps(
+            {**message, 'created_at': message['created_at'].isoformat()}
+        )
+
+    @staticmethod
+    def _load(data: bytes) -> Dict[str, Any]:
+        message = json.loads(data)
+        message['created_at'] = datetime.fromisoformat(message['created_at'])
+        return message
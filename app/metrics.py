@@ -0,0 +1,221 @@
+import functools, os, time
+
+from prometheus_client import (CollectorRegistry,
+                               Counter,
+                               Histogram,
+                               REGISTRY,
+                               generate_latest)
+from prometheus_client.core import (CounterMetricFamily,
+                                    GaugeMetricFamily,
+                                    HistogramMetricFamily)
+from prometheus_client.multiprocess import MultiProcessCollector
+from typing import Any, Callable, Dict, Iterable
+
+from .config import settings
+
+
+HTTP_REQUEST_DURATION = Histogram(
+    'http_request_duration_seconds',
+    'Время обработки HTTP-запроса',
+    ['method', 'route', 'status']
+)
+WS_FRAMES_IN = Counter(
+    'ws_frames_in_total',
+    'Кадры, полученные от клиентов'
+)
+WS_FRAMES_OUT = Counter(
+    'ws_frames_out_total',
+    'Кадры, отправленные клиентам'
+)
+WS_SEND_DURATION = Histogram(
+    'ws_send_duration_seconds',
+    'Время отправки кадра в сокет',
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 5)
+)
+DB_QUERY_DURATION = Histogram(
+    'db_query_duration_seconds',
+    'Время выполнения функций crud',
+    ['function']
+)
+DB_POOL_CHECKOUT_DURATION = Histogram(
+    'db_pool_checkout_duration_seconds',
+    'Время получения соединения из пула SQLAlchemy',
+    ['engine'],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 5, 30)
+)
+REDIS_COMMAND_DURATION = Histogram(
+    'redis_command_duration_seconds',
+    'Время выполнения команд Redis',
+    ['command'],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+)
+
+
+def timed(func):
+    """Декоратор замера времени асинхронной функции crud."""
+
+    histogram = DB_QUERY_DURATION.labels(func.__name__)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - started_at)
+
+    return wrapper
+
+
+def instrument_pool(pool, engine_name: str):
+    """Замер ожидания соединения из пула SQLAlchemy."""
+
+    histogram = DB_POOL_CHECKOUT_DURATION.labels(engine_name)
+    connect = pool.connect
+
+    @functools.wraps(connect)
+    def timed_connect(*args, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            return connect(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - started_at)
+
+    pool.connect = timed_connect
+
+
+def instrument_redis(client):
+    """Замер времени команд и конвейеров клиента redis.asyncio."""
+
+    execute_command = client.execute_command
+    create_pipeline = client.pipeline
+
+    @functools.wraps(execute_command)
+    async def timed_execute_command(*args, **options):
+        started_at = time.perf_counter()
+        try:
+            return await execute_command(*args, **options)
+        finally:
+            REDIS_COMMAND_DURATION.labels(str(args[0]).upper()).observe(
+                time.perf_counter() - started_at
+            )
+
+    @functools.wraps(create_pipeline)
+    def timed_pipeline(*args, **kwargs):
+        pipeline = create_pipeline(*args, **kwargs)
+        execute = pipeline.execute
+
+        async def timed_execute(*execute_args, **execute_kwargs):
+            started_at = time.perf_counter()
+            try:
+                return await execute(*execute_args, **execute_kwargs)
+            finally:
+                REDIS_COMMAND_DURATION.labels('PIPELINE').observe(
+                    time.perf_counter() - started_at
+                )
+
+        pipeline.execute = timed_execute
+        return pipeline
+
+    client.execute_command = timed_execute_command
+    client.pipeline = timed_pipeline
+
+
+# Границы гистограмм показателей компонентов, заданных списком значений
+# (например, глубины очередей всех подключений)
+STATS_HISTOGRAM_BUCKETS = {
+    'connection_queue_depth': (0, 1, 10, 50, 100, 200, 500, 1000),
+}
+
+
+def pool_stats(pool) -> Dict[str, Any]:
+    """Состояние пула соединений SQLAlchemy."""
+
+    return {
+        'size': pool.size(),
+        'checked_out': pool.checkedout(),
+        'idle': pool.checkedin(),
+        'overflow': max(pool.overflow(), 0),
+    }
+
+
+class StatsCollector:
+    """Показатели компонентов, снимаемые в момент запроса /metrics.
+
+    Источники - объекты с методом stats() (пул WebSocket, кэш токенов,
+    пулы соединений), их значения не требуют счетчиков на горячем пути.
+    Списки чисел с границами в STATS_HISTOGRAM_BUCKETS отдаются
+    гистограммами распределения текущих значений.
+    """
+
+    def __init__(self):
+        self._sources: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+    def add(self, name: str, stats: Callable[[], Dict[str, Any]]):
+        self._sources[name] = stats
+
+    def collect(self) -> Iterable:
+        node = settings.NODE_ID
+        for name, stats in self._sources.items():
+            for key, value in stats().items():
+                metric_name = f'{name}_{key}'
+                if key in STATS_HISTOGRAM_BUCKETS:
+                    yield histogram_family(
+                        metric_name, f'{name}: {key}', node,
+                        value, STATS_HISTOGRAM_BUCKETS[key]
+                    )
+                    continue
+                if not isinstance(value, (int, float)):
+                    continue
+                # Накопительные значения отдаются как счетчики
+                if key in ('local_hits', 'shared_hits', 'misses',
+                           'invalidations'):
+                    metric = CounterMetricFamily(
+                        metric_name, f'{name}: {key}', labels=['node']
+                    )
+                else:
+                    metric = GaugeMetricFamily(
+                        metric_name, f'{name}: {key}', labels=['node']
+                    )
+                metric.add_metric([node], value)
+                yield metric
+
+
+def histogram_family(
+        name: str,
+        documentation: str,
+        node: str,
+        values: Iterable[float],
+        bounds: Iterable[float]
+    ) -> HistogramMetricFamily:
+    """Гистограмма по набору текущих значений."""
+
+    values = list(values)
+    buckets = [
+        (str(bound), sum(1 for value in values if value <= bound))
+        for bound in bounds
+    ]
+    buckets.append(('+Inf', len(values)))
+    metric = HistogramMetricFamily(name, documentation, labels=['node'])
+    metric.add_metric([node], buckets, sum(values))
+    return metric
+
+
+stats_collector = StatsCollector()
+REGISTRY.register(stats_collector)
+
+
+def render_metrics() -> bytes:
+    """Текст метрик в формате Prometheus.
+
+    При нескольких процессах (PROMETHEUS_MULTIPROC_DIR) счетчики
+    и гистограммы собираются по всем процессам, показатели компонентов -
+    по процессу, обработавшему запрос.
+    """
+
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    MultiProcessCollector(registry)
+    registry.register(stats_collector)
+    return generate_latest(registry)
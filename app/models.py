@@ -1,5 +1,14 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, BOOLEAN
+from sqlalchemy import (Column,
+                        Integer,
+                        String,
+                        ForeignKey,
+                        DateTime,
+                        BOOLEAN,
+                        Index,
+                        func)
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import relationship
+from sqlalchemy.sql.functions import GenericFunction
 from datetime import datetime
 
 from .database import Base
@@ -17,14 +26,85 @@ class User(Base):
     is_subscribed_to_bot = Column(BOOLEAN, default=False)
 
 
+# В postgres таблица секционирована по месяцам created_at (см. миграцию
+# и app/partitions.py), первичный ключ в ней - (id, created_at).
+# В модели ключ - только id, чтобы в sqlite стенда нагрузочных тестов
+# id оставался автоинкрементным.
 class Message(Base):
     __tablename__ = 'messages'
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     sender_id = Column(Integer, ForeignKey('users.id'))
     receiver_id = Column(Integer, ForeignKey('users.id'))
     content = Column(String)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
 
     sender = relationship('User', foreign_keys=[sender_id])
     receiver = relationship('User', foreign_keys=[receiver_id])
+
+
+# Полнотекстовый поиск по сообщениям: генерируемый столбец
+# messages.content_tsv (tsvector с этой конфигурацией) и индекс GIN
+# по нему создаются миграцией. В модели столбец не объявлен, так как
+# sqlite стенда нагрузочных тестов его не поддерживает.
+MESSAGE_SEARCH_CONFIG = 'russian'
+MESSAGE_SEARCH_COLUMN = 'content_tsv'
+MESSAGE_SEARCH_INDEX = 'ix_messages_content_tsv'
+
+# Месячные секции messages: messages_yYYYYmMM, и секция по умолчанию
+MESSAGE_PARTITION_PREFIX = 'messages_y'
+MESSAGE_DEFAULT_PARTITION = 'messages_default'
+
+
+# Сводка диалога для каждого из его участников: последнее сообщение
+# и число непрочитанных входящих. Обновляется при сохранении сообщений.
+class Conversation(Base):
+    __tablename__ = 'conversations'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    peer_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    last_sender_id = Column(Integer, nullable=False)
+    last_content = Column(String, nullable=False)
+    last_message_at = Column(DateTime, nullable=False)
+    unread_count = Column(Integer, nullable=False, default=0)
+    read_at = Column(DateTime, nullable=True)
+
+
+class least(GenericFunction):
+    inherit_cache = True
+
+
+class greatest(GenericFunction):
+    inherit_cache = True
+
+
+# В sqlite (нагрузочные тесты) least/greatest - это min/max
+# от нескольких аргументов
+@compiles(least, 'sqlite')
+def compile_least_sqlite(element, compiler, **kw):
+    return f'min({compiler.process(element.clauses, **kw)})'
+
+
+@compiles(greatest, 'sqlite')
+def compile_greatest_sqlite(element, compiler, **kw):
+    return f'max({compiler.process(element.clauses, **kw)})'
+
+
+# Индекс для выборки переписки двух пользователей независимо от направления
+# сообщений: пара (least, greatest) однозначно задает диалог, а
+# (created_at, id) - порядок сообщений в нем для постраничной выдачи.
+Index(
+    'ix_messages_conversation',
+    func.least(Message.sender_id, Message.receiver_id),
+    func.greatest(Message.sender_id, Message.receiver_id),
+    Message.created_at,
+    Message.id
+)
+
+# Список диалогов пользователя от последнего активного
+Index(
+    'ix_conversations_user_last_message',
+    Conversation.user_id,
+    Conversation.last_message_at,
+    Conversation.peer_id
+)
@@ -0,0 +1,144 @@
+from redis.asyncio import Redis
+
+from .protocol import dumps
+from .websocket_manager import Connection
+
+
+# Добавление сообщения с обрезкой самых старых записей сверх лимита
+# и публикацией события для уведомлений в телеграм
+PUSH_SCRIPT = '''
+local length = redis.call('RPUSH', KEYS[1], ARGV[1])
+local max_len = tonumber(ARGV[2])
+if max_len > 0 and length > max_len then
+    redis.call('LTRIM', KEYS[1], length - max_len, -1)
+    redis.call('INCRBY', KEYS[2], length - max_len)
+    length = max_len
+end
+redis.call(
+    'XADD', KEYS[3], 'MAXLEN', '~', ARGV[4], '*',
+    'user_id', ARGV[3], 'count', length
+)
+return length
+'''
+
+EVENTS_STREAM = 'events:offline_messages'
+
+# Перенос очередной порции из начала очереди в список обрабатываемых
+TAKE_SCRIPT = '''
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+    redis.call('RPUSH', KEYS[2], unpack(items))
+end
+return items
+'''
+
+# Возврат неподтвержденной порции в начало очереди с сохранением порядка
+RESTORE_SCRIPT = '''
+local items = redis.call('LRANGE', KEYS[2], 0, -1)
+for i = #items, 1, -1 do
+    redis.call('LPUSH', KEYS[1], items[i])
+end
+redis.call('DEL', KEYS[2])
+return #items
+'''
+
+
+class OfflineQueue:
+    """Очередь сообщений для пользователей не в сети.
+
+    Сообщения хранятся в Redis-списке unsent_messages:{user_id}.
+    При подключении очередь досылается порциями: порция переносится
+    в список unsent_processing:{user_id} и удаляется из него только после
+    того, как все ее кадры отправлены в сокет. Если отправка прервалась,
+    порция возвращается в начало очереди.
+
+    О каждом добавлении публикуется событие в поток
+    events:offline_messages, по которому бот отправляет уведомления.
+
+    Если задан max_len, самые старые записи сверх лимита удаляются
+    (сами сообщения остаются в истории в базе данных), а клиенту при
+    досылке сообщается, сколько записей было пропущено.
+    """
+
+    LOCK_TTL = 60
+
+    def __init__(
+            self,
+            redis: Redis,
+            chunk_size: int,
+            max_len: int,
+            events_max_len: int
+        ):
+        self._redis = redis
+        self._chunk_size = chunk_size
+        self._max_len = max_len
+        self._events_max_len = events_max_len
+        self._push = redis.register_script(PUSH_SCRIPT)
+        self._take = redis.register_script(TAKE_SCRIPT)
+        self._restore = redis.register_script(RESTORE_SCRIPT)
+
+    async def push(self, user_id: int, message: str) -> int:
+        """Добавление сообщения в очередь, возвращает ее длину."""
+
+        return await self._push(
+            keys=[
+                f'unsent_messages:{user_id}',
+                f'unsent_spilled:{user_id}',
+                EVENTS_STREAM,
+            ],
+            args=[message, self._max_len, user_id, self._events_max_len]
+        )
+
+    async def replay(self, user_id: int, connection: Connection) -> int:
+        """Досылка очереди в подключение, возвращает число сообщений.
+
+        Одновременно очередь пользователя досылается только в одно
+        подключение.
+        """
+
+        queue_key = f'unsent_messages:{user_id}'
+        processing_key = f'unsent_processing:{user_id}'
+        lock_key = f'unsent_replaying:{user_id}'
+
+        if not await self._redis.set(lock_key, 1, nx=True, ex=self.LOCK_TTL):
+            return 0
+
+        replayed = 0
+        try:
+            # Порция, не подтвержденная при прошлой досылке
+            await self._restore(keys=[queue_key, processing_key])
+
+            spilled = await self._redis.getdel(f'unsent_spilled:{user_id}')
+            if spilled:
+                await connection.put(dumps({
+                    'type': 'backlog_truncated',
+                    'count': int(spilled)
+                }))
+
+            while True:
+                chunk = await self._take(
+                    keys=[queue_key, processing_key],
+                    args=[self._chunk_size]
+                )
+                if not chunk:
+                    return replayed
+
+                for message in chunk:
+                    await connection.put(message.decode('utf-8'))
+                if not await connection.wait_empty():
+                    raise RuntimeError('Подключение закрыто при досылке')
+
+                # Подтверждение отправки порции
+                async with self._redis.pipeline(transaction=False) as pipe:
+                    pipe.delete(processing_key)
+                    pipe.expire(lock_key, self.LOCK_TTL)
+                    await pipe.execute()
+                replayed += len(chunk)
+
+        except BaseException:
+            await self._restore(keys=[queue_key, processing_key])
+            raise
+
+        finally:
+            await self._redis.delete(lock_key)
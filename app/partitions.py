@@ -0,0 +1,319 @@
+"""Обслуживание месячных секций таблицы messages.
+
+Запуск вручную (например, из cron вместо фоновой задачи):
+    python -m app.partitions
+"""
+
+import asyncio, gzip, logging, os, re
+
+from datetime import date, datetime
+from redis.asyncio import Redis
+from sqlalchemy import Connection, Engine, create_engine, text
+from sqlalchemy.pool import NullPool
+from typing import Any, Dict, List, Optional
+
+from .config import settings
+from .database import redis_client
+from .models import MESSAGE_DEFAULT_PARTITION, MESSAGE_PARTITION_PREFIX
+
+
+logger = logging.getLogger(__name__)
+
+PARTITION_NAME = re.compile(
+    rf'^{MESSAGE_PARTITION_PREFIX}(\d{{4}})m(\d{{2}})$'
+)
+ARCHIVED_COLUMNS = 'id, sender_id, receiver_id, content, created_at'
+
+# Продление блокировки, только если она все еще принадлежит экземпляру
+EXTEND_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+def month_start(value: date) -> date:
+    return date(value.year, value.month, 1)
+
+
+def add_months(month: date, count: int) -> date:
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f'{MESSAGE_PARTITION_PREFIX}{month.year}m{month.month:02d}'
+
+
+def partition_month(name: str) -> Optional[date]:
+    match = PARTITION_NAME.match(name)
+    if match is None:
+        return None
+    return date(int(match[1]), int(match[2]), 1)
+
+
+def partition_bounds(month: date) -> str:
+    return f"FROM ('{month}') TO ('{add_months(month, 1)}')"
+
+
+def create_partition_sql(month: date) -> str:
+    return (
+        f'CREATE TABLE IF NOT EXISTS {partition_name(month)} '
+        f'PARTITION OF messages FOR VALUES {partition_bounds(month)}'
+    )
+
+
+class PartitionManager:
+    """Создание будущих секций messages и архивирование старых.
+
+    Секции создаются на months_ahead месяцев вперед. Если задан срок
+    хранения retention_months, секции, целиком вышедшие за него,
+    отсоединяются, выгружаются в archive_dir в виде gzip CSV
+    (messages_yYYYYmMM.csv.gz) и удаляются. Строки секции по умолчанию
+    переносятся в месячные секции при их создании или архивировании.
+
+    Фоновое обслуживание выполняется не чаще раза в interval секунд
+    на весь кластер (блокировка в Redis, продлевается, пока идет
+    архивирование) в отдельном потоке и с отдельными соединениями,
+    не занимая пул соединений приложения.
+    """
+
+    LOCK_KEY = 'messages:partitions:lock'
+
+    def __init__(
+            self,
+            engine: Engine,
+            redis: Redis,
+            months_ahead: int,
+            retention_months: int,
+            archive_dir: str,
+            interval: float
+        ):
+        self._engine = engine
+        self._redis = redis
+        self._months_ahead = months_ahead
+        self._retention_months = retention_months
+        self._archive_dir = archive_dir
+        self._interval = interval
+        self._extend_lock = redis.register_script(EXTEND_LOCK_SCRIPT)
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        # Секционирование есть только в postgres, не в sqlite стенда
+        return self._engine.dialect.name == 'postgresql'
+
+    async def start(self):
+        if self.enabled:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def maintain(self, today: Optional[date] = None) -> Dict[str, Any]:
+        """Создание будущих секций и архивирование устаревших."""
+
+        today = today or datetime.utcnow().date()
+        result = {'created': self.create_partitions(today), 'archived': []}
+        if self._retention_months > 0:
+            result['archived'] = self.archive_expired(today)
+        return result
+
+    def create_partitions(self, today: date) -> List[str]:
+        created = []
+        month = month_start(today)
+        with self._engine.begin() as connection:
+            connection.execute(text("SET LOCAL lock_timeout = '5s'"))
+            for offset in range(self._months_ahead + 1):
+                start = add_months(month, offset)
+                name = partition_name(start)
+                exists = connection.scalar(
+                    text('SELECT to_regclass(:name)'), {'name': name}
+                )
+                if exists is not None:
+                    continue
+                if self._move_from_default(connection, start):
+                    connection.execute(text(
+                        f'ALTER TABLE messages ATTACH PARTITION {name} '
+                        f'FOR VALUES {partition_bounds(start)}'
+                    ))
+                else:
+                    connection.execute(text(create_partition_sql(start)))
+                created.append(name)
+        return created
+
+    def _move_from_default(self, connection: Connection, month: date) -> bool:
+        """Перенос строк месяца из секции по умолчанию в отдельную
+        (неприсоединенную) таблицу секции.
+
+        Секцию нельзя создать, пока строки ее диапазона лежат в секции
+        по умолчанию. Возвращает False, если таких строк нет.
+        """
+
+        bounds = {'start': month, 'stop': add_months(month, 1)}
+        has_rows = connection.scalar(text(f'''
+            SELECT EXISTS (
+                SELECT 1 FROM {MESSAGE_DEFAULT_PARTITION}
+                WHERE created_at >= :start AND created_at < :stop
+            )
+        '''), bounds)
+        if not has_rows:
+            return False
+
+        name = partition_name(month)
+        connection.execute(text(
+            f'CREATE TABLE IF NOT EXISTS {name} (LIKE messages '
+            f'INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING GENERATED)'
+        ))
+        connection.execute(text(f'''
+            WITH moved AS (
+                DELETE FROM {MESSAGE_DEFAULT_PARTITION}
+                WHERE created_at >= :start AND created_at < :stop
+                RETURNING {ARCHIVED_COLUMNS}
+            )
+            INSERT INTO {name} ({ARCHIVED_COLUMNS})
+            SELECT {ARCHIVED_COLUMNS} FROM moved
+        '''), bounds)
+        return True
+
+    def archive_expired(self, today: date) -> List[str]:
+        """Архивирование секций, все строки которых старше срока хранения.
+
+        Обрабатываются и отсоединенные, но не удаленные секции
+        (если прошлое архивирование было прервано).
+        """
+
+        cutoff = add_months(month_start(today), -self._retention_months)
+        with self._engine.begin() as connection:
+            # Строки устаревших месяцев из секции по умолчанию
+            # архивируются как отсоединенные секции
+            months = connection.execute(text(f'''
+                SELECT DISTINCT date_trunc('month', created_at)::date
+                FROM {MESSAGE_DEFAULT_PARTITION}
+                WHERE created_at < :cutoff
+            '''), {'cutoff': cutoff}).scalars().all()
+            for month in months:
+                self._move_from_default(connection, month)
+
+            tables = connection.execute(text("""
+                SELECT c.relname, i.inhparent IS NOT NULL AS attached
+                FROM pg_class c
+                LEFT JOIN pg_inherits i ON i.inhrelid = c.oid
+                WHERE c.relname LIKE :pattern AND c.relkind = 'r'
+            """), {'pattern': f'{MESSAGE_PARTITION_PREFIX}%'}).all()
+
+        archived = []
+        for name, attached in sorted(tables):
+            month = partition_month(name)
+            if month is None or add_months(month, 1) > cutoff:
+                continue
+            self.archive_partition(name, attached)
+            archived.append(name)
+        return archived
+
+    def archive_partition(self, name: str, attached: bool = True) -> str:
+        """Отсоединение, выгрузка в gzip CSV и удаление секции.
+
+        Файл записывается под временным именем и переименовывается
+        после fsync, секция удаляется только после этого.
+        """
+
+        if attached:
+            with self._engine.begin() as connection:
+                connection.execute(text("SET LOCAL lock_timeout = '5s'"))
+                connection.execute(
+                    text(f'ALTER TABLE messages DETACH PARTITION {name}')
+                )
+
+        os.makedirs(self._archive_dir, exist_ok=True)
+        # Строки месяца, пришедшие после его архивирования, выгружаются
+        # в отдельный файл
+        path = os.path.join(self._archive_dir, f'{name}.csv.gz')
+        index = 0
+        while os.path.exists(path):
+            index += 1
+            path = os.path.join(self._archive_dir, f'{name}.{index}.csv.gz')
+        temporary_path = f'{path}.tmp'
+        connection = self._engine.raw_connection()
+        try:
+            with open(temporary_path, 'wb') as output:
+                with gzip.GzipFile(fileobj=output, mode='wb') as archive:
+                    cursor = connection.cursor()
+                    cursor.copy_expert(
+                        f'COPY {name} ({ARCHIVED_COLUMNS}) '
+                        f'TO STDOUT WITH (FORMAT csv, HEADER)',
+                        archive
+                    )
+                    rows = cursor.rowcount
+                    cursor.close()
+                output.flush()
+                os.fsync(output.fileno())
+            connection.commit()
+        finally:
+            connection.close()
+        os.replace(temporary_path, path)
+
+        with self._engine.begin() as connection:
+            connection.execute(text(f'DROP TABLE {name}'))
+
+        logger.info('Секция сообщений архивирована', extra={
+            'event': 'partitions.archive',
+            'partition': name,
+            'rows': rows,
+            'path': path,
+        })
+        return path
+
+    async def _run(self):
+        while True:
+            try:
+                locked = await self._redis.set(
+                    self.LOCK_KEY, settings.NODE_ID,
+                    nx=True, ex=max(int(self._interval), 1)
+                )
+                if locked:
+                    result = await self._maintain_locked()
+                    if result['created'] or result['archived']:
+                        logger.info(
+                            'Секции сообщений обновлены',
+                            extra={'event': 'partitions.maintain', **result}
+                        )
+            except Exception as e:
+                logger.error(
+                    'Ошибка обслуживания секций сообщений: %s', e,
+                    extra={'event': 'partitions.error'}
+                )
+            await asyncio.sleep(self._interval)
+
+    async def _maintain_locked(self) -> Dict[str, Any]:
+        """Обслуживание в отдельном потоке с продлением блокировки."""
+
+        ttl = max(int(self._interval), 1)
+        task = asyncio.create_task(asyncio.to_thread(self.maintain))
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=max(ttl / 3, 1))
+            if done:
+                return task.result()
+            await self._extend_lock(
+                keys=[self.LOCK_KEY], args=[settings.NODE_ID, ttl]
+            )
+
+
+# Собственные соединения без пула: выгрузка секции занимает соединение
+# на все время COPY
+partition_manager = PartitionManager(
+    create_engine(settings.database_url, poolclass=NullPool),
+    redis_client,
+    months_ahead=settings.MESSAGES_PARTITIONS_AHEAD,
+    retention_months=settings.MESSAGES_RETENTION_MONTHS,
+    archive_dir=settings.MESSAGES_ARCHIVE_DIR,
+    interval=settings.MESSAGES_PARTITIONS_INTERVAL
+)
+
+
+if __name__ == '__main__':
+    print(partition_manager.maintain())
@@ -0,0 +1,151 @@
+import msgpack, orjson
+
+from typing import Any, Dict, Iterable, Optional, Union
+
+
+MSGPACK_SUBPROTOCOL = 'chat.msgpack.v1'
+
+# Типы кадров бинарного протокола
+CHAT_MESSAGE = 0
+STATUS_UPDATE = 1
+PRESENCE_SUBSCRIBE = 2
+PRESENCE_UNSUBSCRIBE = 3
+STATUS_BATCH = 4
+BACKLOG_TRUNCATED = 5
+
+STATUS_CODES = {'offline': 0, 'online': 1}
+STATUS_NAMES = {code: name for name, code in STATUS_CODES.items()}
+
+
+def dumps(data: Any) -> str:
+    """Кодирование в JSON-строку (ключи-числа приводятся к строкам)."""
+
+    return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+loads = orjson.loads
+
+
+class Frame:
+    """Исходящий кадр, закодированный не более одного раза на формат.
+
+    Кадр, полученный в виде JSON (из Redis или от другого узла),
+    отправляется JSON-клиентам без повторного кодирования.
+    """
+
+    __slots__ = ('_data', '_json', '_msgpack')
+
+    def __init__(
+            self,
+            data: Optional[Dict[str, Any]] = None,
+            json_text: Optional[str] = None
+        ):
+        self._data = data
+        self._json = json_text
+        self._msgpack: Optional[bytes] = None
+
+    @property
+    def data(self) -> Dict[str, Any]:
+        if self._data is None:
+            self._data = loads(self._json)
+        return self._data
+
+    @property
+    def json(self) -> str:
+        if self._json is None:
+            self._json = dumps(self.data)
+        return self._json
+
+    @property
+    def msgpack(self) -> bytes:
+        if self._msgpack is None:
+            self._msgpack = msgpack.packb(_compact(self.data))
+        return self._msgpack
+
+
+OutgoingMessage = Union[str, Frame]
+
+
+class JsonCodec:
+    """Текстовый протокол по умолчанию."""
+
+    subprotocol = None
+    binary = False
+
+    def encode(self, message: OutgoingMessage) -> str:
+        if isinstance(message, Frame):
+            return message.json
+        return message
+
+    def decode(self, data: str) -> Dict[str, Any]:
+        return loads(data)
+
+
+class MsgpackCodec:
+    """Бинарный протокол chat.msgpack.v1.
+
+    Кадр - массив msgpack, первый элемент которого - тип кадра:
+    [0, receiver_id, content] - сообщение от клиента,
+    [0, sender_id, receiver_id, content] - сообщение клиенту,
+    [1, user_id, status], [2, [user_id, ...]], [3, [user_id, ...]],
+    [4, {user_id: status}], [5, count]. Статусы online/offline
+    передаются числами 1/0.
+    """
+
+    subprotocol = MSGPACK_SUBPROTOCOL
+    binary = True
+
+    def encode(self, message: OutgoingMessage) -> bytes:
+        if isinstance(message, Frame):
+            return message.msgpack
+        return Frame(json_text=message).msgpack
+
+    def decode(self, data: bytes) -> Dict[str, Any]:
+        frame = msgpack.unpackb(data, strict_map_key=False)
+        frame_type = frame[0]
+        if frame_type == CHAT_MESSAGE:
+            return {'receiver_id': frame[1], 'content': frame[2]}
+        if frame_type == STATUS_UPDATE:
+            return {
+                'type': 'status_update',
+                'user_id': frame[1],
+                'status': STATUS_NAMES.get(frame[2], frame[2])
+            }
+        if frame_type == PRESENCE_SUBSCRIBE:
+            return {'type': 'presence_subscribe', 'user_ids': frame[1]}
+        if frame_type == PRESENCE_UNSUBSCRIBE:
+            return {'type': 'presence_unsubscribe', 'user_ids': frame[1]}
+        raise ValueError(f'Неизвестный тип кадра: {frame_type}')
+
+
+def _compact(data: Dict[str, Any]) -> Any:
+    """Преобразование кадра в компактный массив бинарного протокола."""
+
+    frame_type = data.get('type')
+    if frame_type is None and 'sender_id' in data:
+        return [
+            CHAT_MESSAGE,
+            data['sender_id'],
+            data['receiver_id'],
+            data['content']
+        ]
+    if frame_type == 'status_batch':
+        return [STATUS_BATCH, {
+            int(user_id): STATUS_CODES.get(status, status)
+            for user_id, status in data['statuses'].items()
+        }]
+    if frame_type == 'backlog_truncated':
+        return [BACKLOG_TRUNCATED, data['count']]
+    return data
+
+
+json_codec = JsonCodec()
+msgpack_codec = MsgpackCodec()
+
+
+def negotiate(subprotocols: Iterable[str]):
+    """Выбор протокола по списку, предложенному клиентом."""
+
+    if MSGPACK_SUBPROTOCOL in subprotocols:
+        return msgpack_codec
+    return json_codec
@@ -1,52 +1,102 @@
-import json
-import redis.asyncio as aioredis
+import logging, time
 
 from fastapi import (APIRouter,
                      Depends,
+                     Header,
                      HTTPException,
                      status,
                      WebSocket,
                      WebSocketDisconnect,
-                     Query)
-from sqlalchemy.orm import Session
-from typing import List
-
-from .database import get_db
+                     Query,
+                     Response)
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from redis.exceptions import RedisError
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Literal, Optional
+
+from .database import get_async_db, redis_client
 from .models import User
 from .schemas import (UserCreate,
                       UserLogin,
                       MessageBase,
+                      MessageSearchResult,
                       UserBase,
+                      ConversationBase,
                       ChatIdRequest,
                       UserLoginResponse)
-from .crud import (create_user,
-                   update_user_token,
-                   save_message,
-                   get_messages_history,
-                   get_current_user,
-                   get_user_by_tg_username,
-                   subscribe_user_to_tgbot,
-                   get_subscribed_users,
-                   get_all_users,
-                   get_user_info_by_id)
-from .utils import verify_password, send_message
+from .async_crud import (create_user,
+                         update_user_token,
+                         get_messages_history,
+                         get_current_user,
+                         get_user_by_username,
+                         get_user_by_tg_username,
+                         subscribe_user_to_tgbot,
+                         get_users_page,
+                         iter_users,
+                         get_user_info_by_id,
+                         get_conversations,
+                         mark_conversation_read,
+                         search_messages,
+                         MESSAGE_FIELDS,
+                         MESSAGE_SEARCH_FIELDS,
+                         CONVERSATION_FIELDS)
+from .auth import password_hasher, PasswordHasherBusy
+from .utils import encode_cursor, decode_cursor
 from .websocket_manager import WebSocketPool
+from .message_writer import MessageWriter
+from .cluster import ClusterRouter
+from .offline_queue import OfflineQueue
+from .protocol import dumps
+from .metrics import WS_FRAMES_IN
+from .users_version import users_version
+from .config import settings
+
 
+logger = logging.getLogger(__name__)
 
-http_router = APIRouter()
+http_router = APIRouter(default_response_class=ORJSONResponse)
 ws_router = APIRouter()
-redis_client = aioredis.from_url('redis://redis:6379')
-websocket_pool = WebSocketPool()
+websocket_pool = WebSocketPool(
+    flush_interval=settings.PRESENCE_FLUSH_INTERVAL,
+    max_subscriptions=settings.PRESENCE_MAX_SUBSCRIPTIONS,
+    max_size=settings.WS_QUEUE_MAX_SIZE,
+    high_water=settings.WS_QUEUE_HIGH_WATER,
+    slow_consumer_timeout=settings.WS_SLOW_CONSUMER_TIMEOUT,
+    send_timeout=settings.WS_SEND_TIMEOUT,
+    status_policy=settings.WS_STATUS_POLICY
+)
+offline_queue = OfflineQueue(
+    redis_client,
+    chunk_size=settings.UNSENT_REPLAY_CHUNK,
+    max_len=settings.UNSENT_MAX_LEN,
+    events_max_len=settings.OFFLINE_EVENTS_MAX_LEN
+)
+cluster = ClusterRouter(
+    redis_client,
+    websocket_pool,
+    node_id=settings.NODE_ID,
+    heartbeat_interval=settings.CLUSTER_HEARTBEAT_INTERVAL,
+    node_ttl=settings.CLUSTER_NODE_TTL
+)
+message_writer = MessageWriter(
+    redis_client,
+    batch_size=settings.MESSAGE_BATCH_SIZE,
+    flush_interval=settings.MESSAGE_FLUSH_INTERVAL,
+    max_queue_size=settings.MESSAGE_QUEUE_SIZE,
+    dead_letter_max_len=settings.MESSAGE_DEAD_LETTER_MAX_LEN,
+    recovery_interval=settings.MESSAGE_RECOVERY_INTERVAL
+)
 
 
 @http_router.post('/api/registration', response_model=UserLoginResponse)
-def register(user: UserCreate, db: Session = Depends(get_db)):
+async def register(
+    user: UserCreate,
+    db: AsyncSession = Depends(get_async_db)
+):
     """Регистрация пользователя."""
 
     # Проверка, существует ли пользователь с таким именем
-    existing_user = db.query(User).filter(
-        User.username == user.username
-    ).first()
+    existing_user = await get_user_by_username(db, user.username)
     if existing_user:
         raise HTTPException(
             status_code=400,
@@ -54,9 +104,7 @@ def register(user: UserCreate, db: Session = Depends(get_db)):
         )
 
     # Проверка, существует ли пользователь с таким ником в телеге
-    existing_tg_user = db.query(User).filter(
-        User.tg_username == user.tg_username
-    ).first()
+    existing_tg_user = await get_user_by_tg_username(db, user.tg_username)
     if existing_tg_user:
         raise HTTPException(
             status_code=400,
@@ -66,30 +114,50 @@ def register(user: UserCreate, db: Session = Depends(get_db)):
             )
         )
 
-    new_user = create_user(db, user)
+    try:
+        new_user = await create_user(db, user)
+    except PasswordHasherBusy as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e)
+        )
     return new_user
 
 
 @http_router.post('/api/login', response_model=UserLoginResponse)
-async def login(user: UserLogin, db: Session = Depends(get_db)):
+async def login(user: UserLogin, db: AsyncSession = Depends(get_async_db)):
     """Вход в систему."""
 
     # Проверяем, существует ли пользователь
-    existing_user = db.query(User).filter(
-        User.username == user.username
-    ).first()
-    
-    if not existing_user or not verify_password(
-        user.password,
-        existing_user.hashed_password
-    ):
+    existing_user = await get_user_by_username(db, user.username)
+
+    is_valid, new_hashed_password = False, None
+    if existing_user:
+        try:
+            is_valid, new_hashed_password = (
+                await password_hasher.verify_and_update(
+                    user.password,
+                    existing_user.hashed_password
+                )
+            )
+        except PasswordHasherBusy as e:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=str(e)
+            )
+
+    if not is_valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail='Неверное имя пользователя или пароль'
         )
 
+    # Перехэширование пароля с актуальными параметрами
+    if new_hashed_password:
+        existing_user.hashed_password = new_hashed_password
+
     # Обновляем токен
-    updated_user = update_user_token(db, existing_user)
+    updated_user = await update_user_token(db, existing_user)
 
     return updated_user
 
@@ -100,138 +168,382 @@ async def login(user: UserLogin, db: Session = Depends(get_db)):
     )
 async def read_messages_history(
     receiver_id: int,
-    db: Session = Depends(get_db),
+    limit: int = Query(50, ge=1, le=500),
+    before: Optional[str] = Query(None),
+    after: Optional[str] = Query(None),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user),
     
 ):
-    """Просмотр истории сообщений."""
+    """Просмотр истории сообщений.
+
+    Сообщения выдаются страницами. Курсоры соседних страниц передаются
+    в заголовках X-Prev-Cursor (более старые сообщения, параметр before)
+    и X-Next-Cursor (более новые, параметр after).
+    """
+
+    if before and after:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail='Нельзя одновременно указывать before и after'
+        )
+
+    try:
+        before_position = decode_cursor(before) if before else None
+        after_position = decode_cursor(after) if after else None
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
 
     sender_id = current_user.id
-    return get_messages_history(db, sender_id, receiver_id)
+    messages_history = await get_messages_history(
+        db,
+        sender_id,
+        receiver_id,
+        limit=limit,
+        before=before_position,
+        after=after_position
+    )
+
+    headers = {}
+    if messages_history:
+        first, last = messages_history[0], messages_history[-1]
+        headers['X-Prev-Cursor'] = encode_cursor(first.created_at, first.id)
+        headers['X-Next-Cursor'] = encode_cursor(last.created_at, last.id)
+
+    # Столбцы строк идут в порядке полей MessageBase, id - последним
+    return ORJSONResponse(
+        [dict(zip(MESSAGE_FIELDS, row)) for row in messages_history],
+        headers=headers
+    )
+
+
+@http_router.get(
+        '/api/search/messages',
+        response_model=List[MessageSearchResult]
+    )
+async def search_messages_history(
+    q: str = Query(..., min_length=1, max_length=200),
+    peer_id: Optional[int] = Query(None),
+    limit: int = Query(20, ge=1, le=100),
+    before: Optional[str] = Query(None),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Поиск по сообщениям диалогов текущего пользователя.
+
+    Найденные сообщения выдаются от новых к старым с фрагментом текста
+    snippet, в котором совпадения выделены тегами <mark>, а остальной
+    текст экранирован для вывода как HTML. peer_id ограничивает поиск
+    диалогом с одним пользователем. Курсор следующей страницы
+    передается в заголовке X-Next-Cursor (параметр before).
+    """
+
+    try:
+        before_position = decode_cursor(before) if before else None
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+
+    messages = await search_messages(
+        db,
+        current_user.id,
+        q,
+        peer_id=peer_id,
+        limit=limit,
+        before=before_position
+    )
+
+    headers = {}
+    if len(messages) == limit:
+        last = messages[-1]
+        headers['X-Next-Cursor'] = encode_cursor(last.created_at, last.id)
+
+    # Столбцы строк идут в порядке MESSAGE_SEARCH_FIELDS, id - последним
+    return ORJSONResponse(
+        [dict(zip(MESSAGE_SEARCH_FIELDS, row)) for row in messages],
+        headers=headers
+    )
+
+
+@http_router.get(
+        '/api/conversations',
+        response_model=List[ConversationBase]
+    )
+async def read_conversations(
+    limit: int = Query(50, ge=1, le=200),
+    before: Optional[str] = Query(None),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Список диалогов текущего пользователя.
+
+    Диалоги выдаются от последнего активного с последним сообщением
+    и числом непрочитанных. Курсор следующей страницы передается
+    в заголовке X-Next-Cursor (параметр before).
+    """
+
+    try:
+        before_position = decode_cursor(before) if before else None
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+
+    conversations = await get_conversations(
+        db, current_user.id, limit=limit, before=before_position
+    )
+
+    headers = {}
+    if len(conversations) == limit:
+        last = conversations[-1]
+        headers['X-Next-Cursor'] = encode_cursor(
+            last.last_message_at, last.peer_id
+        )
+    return ORJSONResponse(
+        [dict(zip(CONVERSATION_FIELDS, row)) for row in conversations],
+        headers=headers
+    )
+
+
+@http_router.post(
+        '/api/conversations/{peer_id}/read',
+        status_code=status.HTTP_204_NO_CONTENT
+    )
+async def read_conversation(
+    peer_id: int,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Отметка о прочтении диалога с пользователем peer_id."""
+
+    if not await mark_conversation_read(db, current_user.id, peer_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail='Диалог не найден'
+        )
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
 @ws_router.websocket('/api/ws/{user_id}')
 async def handle_websocket_endpoint(
     websocket: WebSocket,
     user_id: int,
-    db: Session = Depends(get_db),
 ):
-    headers = websocket.scope.get('headers')
-    print(f"Headers при подключении пользователя {user_id}: {headers}")
-
+    # Сессия базы данных на время подключения не открывается: сообщения
+    # сохраняет message_writer, занимая соединение только на запись пакета
     # Подключение пользователя
-    await websocket_pool.connect(websocket, user_id)
-    await websocket_pool.notify_user_status(user_id, 'online')
-
-    # Проверка наличия в редисе недоставленных сообщений
-    unsent_key = f'unsent_messages:{user_id}'
-    unsent_messages = await redis_client.lrange(unsent_key, 0, -1)
-
-    # Досылка при их наличии
-    for message in unsent_messages:
-        message_data = json.loads(message)
+    connected_at = time.monotonic()
+    connection = await websocket_pool.connect(websocket, user_id)
+    # Подключение снимается из пула и таблицы присутствия при любом
+    # завершении, в том числе при ошибке регистрации или досылки
+    try:
+        await cluster.register(user_id)
+        await cluster.notify_user_status(user_id, 'online')
+        logger.info('Пользователь подключился', extra={
+            'event': 'ws.connect',
+            'user_id': user_id,
+            'subprotocol': connection.codec.subprotocol,
+        })
+
+        # Досылка недоставленных сообщений из редиса
         try:
-            await websocket.send_text(json.dumps(message_data))
-        except RuntimeError as e:
-            print(f"Ошибка при отправке сообщения через WebSocket: {e}")
-            break
-    await redis_client.delete(unsent_key)
+            await offline_queue.replay(user_id, connection)
+        except (RuntimeError, RedisError) as e:
+            logger.warning(
+                'Ошибка досылки недоставленных сообщений: %s', e,
+                extra={'event': 'ws.replay_error', 'user_id': user_id}
+            )
 
-    try:
         while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
+            if connection.codec.binary:
+                data = await websocket.receive_bytes()
+            else:
+                data = await websocket.receive_text()
+            WS_FRAMES_IN.inc()
+            message = connection.codec.decode(data)
 
             # Обработка обновления статуса пользователя
             if message.get('type') == 'status_update':
                 status_user_id = message['user_id']
                 status = message['status']
-                await websocket_pool.notify_user_status(status_user_id, status)
+                await cluster.notify_user_status(status_user_id, status)
+                continue
+
+            # Подписка на статусы пользователей (например, списка контактов)
+            if message.get('type') == 'presence_subscribe':
+                user_ids = [
+                    int(watched_id)
+                    for watched_id in message['user_ids']
+                ][:settings.PRESENCE_MAX_SUBSCRIPTIONS]
+                statuses = await cluster.get_statuses(user_ids)
+                websocket_pool.subscribe(connection, statuses)
+                continue
+
+            if message.get('type') == 'presence_unsubscribe':
+                websocket_pool.unsubscribe(
+                    connection,
+                    [int(watched_id) for watched_id in message['user_ids']]
+                )
                 continue
 
             # Обработка отправки сообщений
-            receiver_id = message['receiver_id']
-            message_content = message['content']
-            save_message(db, user_id, receiver_id, message_content)
+            started_at = time.perf_counter()
+            receiver_id = message.get('receiver_id')
+            message_content = message.get('content')
+            if (
+                type(receiver_id) is not int or
+                not isinstance(message_content, str)
+            ):
+                logger.warning('Некорректное сообщение', extra={
+                    'event': 'ws.invalid_message',
+                    'user_id': user_id,
+                })
+                continue
+            await message_writer.submit(
+                user_id, receiver_id, message_content
+            )
 
-            if receiver_id in websocket_pool.connections:
-                message_data = {
-                    'sender_id': user_id,
-                    'receiver_id': receiver_id,
-                    'content': message_content
-                }
-                try:
-                    await send_message(
-                        receiver_id,
-                        json.dumps(message_data),
-                        websocket_pool
-                    )
-                except RuntimeError as e:
-                    print(f"Ошибка отправки сообщения пользователю {receiver_id}: {e}")
-            else:
+            message_data = dumps({
+                'sender_id': user_id,
+                'receiver_id': receiver_id,
+                'content': message_content
+            })
+            try:
+                delivered = await cluster.deliver(receiver_id, message_data)
+            except RuntimeError as e:
+                delivered = True
+                logger.warning(
+                    'Ошибка доставки сообщения: %s', e,
+                    extra={'event': 'ws.deliver_error', 'user_id': receiver_id}
+                )
+
+            if not delivered:
                 # Если получатель оффлайн, сохраняем сообщение в Redis
-                unsent_key = f'unsent_messages:{receiver_id}'
-                await redis_client.rpush(unsent_key, json.dumps({
-                    'sender_id': user_id,
+                await offline_queue.push(receiver_id, message_data)
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Сообщение обработано', extra={
+                    'event': 'ws.message',
+                    'user_id': user_id,
                     'receiver_id': receiver_id,
-                    'content': message_content
-                }))
-                print(f'Пользователь {receiver_id} не в сети. Сообщение сохранено в Redis')
+                    'delivered': delivered,
+                    'latency_ms': (time.perf_counter() - started_at) * 1000,
+                })
 
     except WebSocketDisconnect:
-        print(f'Пользователь {user_id} отключился')
-        await websocket_pool.disconnect(user_id, websocket)
+        logger.info('Пользователь отключился', extra={
+            'event': 'ws.disconnect',
+            'user_id': user_id,
+            'duration': time.monotonic() - connected_at,
+        })
 
     except Exception as e:
-        print(f"Ошибка в WebSocket-соединении с пользователем {user_id}: {e}")
-        await websocket_pool.disconnect(user_id, websocket)
+        logger.error(
+            'Ошибка в WebSocket-соединении: %s', e,
+            extra={'event': 'ws.error', 'user_id': user_id}
+        )
 
-    except RuntimeError as e:
-        print(f"Ошибка при обновлении статуса пользователя {user_id}: {e}")
-        await websocket.close()
+    finally:
+        await websocket_pool.disconnect(user_id, connection)
+        await cluster.unregister(user_id)
 
 
 @http_router.post('/api/subscriptions/{tg_username}')
 async def set_is_subscribed(
     tg_username: str,
     chat_id_request: ChatIdRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Подписать пользователя на бота."""
 
     user = await get_user_by_tg_username(db, tg_username)
-    subscribe_user_to_tgbot(db, user, chat_id_request.chat_id)
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail='Пользователь не найден'
+        )
+    await subscribe_user_to_tgbot(db, user, chat_id_request.chat_id)
     return user
 
  
 @http_router.get('/api/users', response_model=List[UserBase])
 async def get_users(
-    db: Session = Depends(get_db),
-    subscribed: bool = Query(False)
+    db: AsyncSession = Depends(get_async_db),
+    subscribed: Optional[bool] = Query(None),
+    username: Optional[str] = Query(None),
+    after: Optional[int] = Query(None),
+    limit: int = Query(100, ge=1, le=1000),
+    format: Literal['json', 'ndjson'] = Query('json'),
+    if_none_match: Optional[str] = Header(None)
 ):
-    """Получение списка пользователей."""
+    """Получение списка пользователей.
+
+    Пользователи выдаются страницами по возрастанию id, курсор следующей
+    страницы передается в заголовке X-Next-Cursor (параметр after).
+    Фильтры: subscribed - подписка на бота, username - начало имени.
+    В формате ndjson (для бота) все подходящие пользователи выдаются
+    потоком, по одному объекту JSON на строку.
+
+    Ответ помечается ETag по версии списка пользователей: если версия
+    не изменилась, возвращается 304 без запроса к базе данных.
+    """
+
+    # Версия читается до запроса к базе: изменение между ними приведет
+    # лишь к лишней повторной загрузке
+    etag = f'"users-{await users_version.get()}"'
+    headers = {'ETag': etag}
+    if if_none_match is not None and (
+        if_none_match.strip() == '*' or
+        etag in (tag.strip() for tag in if_none_match.split(','))
+    ):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                        headers=headers)
+
+    if format == 'ndjson':
+        async def lines():
+            async for users in iter_users(subscribed, username, after):
+                yield ''.join(dumps(user._asdict()) + '\n' for user in users)
 
-    # Отфильтрованные по подписке пользователи (для бота)
-    if subscribed:
-        return get_subscribed_users(db)
+        return StreamingResponse(
+            lines(), media_type='application/x-ndjson', headers=headers
+        )
 
-    # Вернуть список всех пользователей
-    else:
-        return get_all_users(db)
+    users = await get_users_page(db, subscribed, username, after, limit)
+    if len(users) == limit:
+        headers['X-Next-Cursor'] = str(users[-1].id)
+    return ORJSONResponse(
+        [user._asdict() for user in users],
+        headers=headers
+    )
 
 
 @http_router.get('/api/users/{user_id}', response_model=UserBase)
-def get_user_info(user_id: int, db: Session = Depends(get_db)):
+async def get_user_info(
+    user_id: int,
+    db: AsyncSession = Depends(get_async_db)
+):
     """Получение информации о пользователе."""
 
-    return get_user_info_by_id(user_id, db)
+    return await get_user_info_by_id(user_id, db)
 
 
 @http_router.get('/api/user/{tg_username}', response_model=UserBase)
 async def get_user_by_tg_username_for_bot(
     tg_username: str,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Получение ботом пользователя по имени в телеге."""
 
-    return await get_user_by_tg_username(db, tg_username)
+    user = await get_user_by_tg_username(db, tg_username)
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail='Пользователь не найден'
+        )
+    return user
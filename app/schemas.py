@@ -25,6 +25,10 @@ class MessageBase(BaseModel):
     )
 
 
+class MessageSearchResult(MessageBase):
+    snippet: str
+
+
 class UserBase(BaseModel):
     id: int
     username: str
@@ -37,6 +41,18 @@ class UserBase(BaseModel):
     )
 
 
+class ConversationBase(BaseModel):
+    peer_id: int
+    last_sender_id: int
+    last_content: str
+    last_message_at: datetime
+    unread_count: int
+
+    model_config = ConfigDict(
+        from_attributes=True
+    )
+
+
 class ChatIdRequest(BaseModel):
     chat_id: int
 
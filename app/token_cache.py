@@ -0,0 +1,178 @@
+import asyncio, json, time
+
+from collections import OrderedDict
+from redis.asyncio import Redis
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from .config import settings
+from .database import redis_client
+from .models import User
+
+
+# Поля пользователя, которые хранятся в кэше
+CACHED_FIELDS = (
+    'id',
+    'username',
+    'auth_token',
+    'tg_username',
+    'tg_chat_id',
+    'is_subscribed_to_bot',
+)
+
+# Запись в общий кэш, только если с начала промаха не было
+# ни одной инвалидации
+SET_SCRIPT = """
+local generation = redis.call('GET', KEYS[1]) or '0'
+if generation ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+
+class TokenCache:
+    """Кэш пользователей по токену авторизации.
+
+    Первый уровень - LRU с TTL в памяти процесса, второй - общий для всех
+    экземпляров Redis (auth_token:{token}). При смене токена запись
+    удаляется из Redis, а остальные экземпляры получают событие
+    в канале auth:invalidate и удаляют ее из своей памяти.
+
+    Каждая инвалидация увеличивает счетчик поколений (общий в Redis
+    и локальный в памяти). Пользователь, загруженный из базы при
+    промахе, кэшируется, только если поколение за время загрузки
+    не изменилось: иначе загруженный по старому токену пользователь
+    мог бы вернуться в кэш уже после смены токена.
+    """
+
+    CHANNEL = 'auth:invalidate'
+    GENERATION_KEY = 'auth:generation'
+
+    def __init__(
+            self,
+            redis: Redis,
+            max_size: int,
+            local_ttl: float,
+            shared_ttl: int
+        ):
+        self._redis = redis
+        self._max_size = max_size
+        self._local_ttl = local_ttl
+        self._shared_ttl = shared_ttl
+        self._local: OrderedDict[str, Tuple[float, Dict[str, Any]]] = (
+            OrderedDict()
+        )
+        self._set = redis.register_script(SET_SCRIPT)
+        self._generation = 0
+        self._pubsub = None
+        self._task: Optional[asyncio.Task] = None
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def start(self):
+        self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.subscribe(self.CHANNEL)
+        self._task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._pubsub is not None:
+            await self._pubsub.unsubscribe()
+            await self._pubsub.aclose()
+            self._pubsub = None
+
+    async def get(self, token: str) -> Optional[User]:
+        """Получение пользователя из кэша (None при промахе)."""
+
+        entry = self._local.get(token)
+        if entry is not None:
+            expires_at, data = entry
+            if expires_at > time.monotonic():
+                self._local.move_to_end(token)
+                self.local_hits += 1
+                return User(**data)
+            del self._local[token]
+
+        raw = await self._redis.get(f'auth_token:{token}')
+        if raw is None:
+            self.misses += 1
+            return None
+
+        data = json.loads(raw)
+        self._store_local(token, data)
+        self.shared_hits += 1
+        return User(**data)
+
+    async def get_or_load(
+            self,
+            token: str,
+            load: Callable[[], Awaitable[Optional[User]]]
+        ) -> Optional[User]:
+        """Получение пользователя из кэша или через load при промахе."""
+
+        user = await self.get(token)
+        if user is not None:
+            return user
+
+        local_generation = self._generation
+        shared_generation = await self._redis.get(self.GENERATION_KEY)
+        user = await load()
+        if user is None:
+            return None
+
+        data = {field: getattr(user, field) for field in CACHED_FIELDS}
+        stored = await self._set(
+            keys=[self.GENERATION_KEY, f'auth_token:{token}'],
+            args=[shared_generation or 0, json.dumps(data), self._shared_ttl]
+        )
+        if stored and self._generation == local_generation:
+            self._store_local(token, data)
+        return user
+
+    async def invalidate(self, token: Optional[str]):
+        """Удаление токена из кэша на всех экземплярах."""
+
+        if not token:
+            return
+        self._local.pop(token, None)
+        self._generation += 1
+        self.invalidations += 1
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.incr(self.GENERATION_KEY)
+            pipe.delete(f'auth_token:{token}')
+            pipe.publish(self.CHANNEL, token)
+            await pipe.execute()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self._local),
+            'local_hits': self.local_hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+        }
+
+    def _store_local(self, token: str, data: Dict[str, Any]):
+        self._local[token] = (time.monotonic() + self._local_ttl, data)
+        self._local.move_to_end(token)
+        while len(self._local) > self._max_size:
+            self._local.popitem(last=False)
+
+    async def _listen(self):
+        async for event in self._pubsub.listen():
+            self._generation += 1
+            self._local.pop(event['data'].decode(), None)
+
+
+token_cache = TokenCache(
+    redis_client,
+    max_size=settings.AUTH_CACHE_SIZE,
+    local_ttl=settings.AUTH_CACHE_TTL,
+    shared_ttl=settings.AUTH_CACHE_SHARED_TTL
+)
@@ -0,0 +1,49 @@
+import time
+
+from redis.asyncio import Redis
+
+from .database import redis_client
+
+
+# Если ключ потерян (например, после перезапуска Redis), счет начинается
+# с текущего времени, чтобы не повторить выданные ранее ETag
+BUMP_SCRIPT = """
+local version = redis.call('INCR', KEYS[1])
+if version == 1 then
+    version = tonumber(ARGV[1])
+    redis.call('SET', KEYS[1], version)
+end
+return version
+"""
+
+
+class UsersVersion:
+    """Версия списка пользователей для условных запросов (ETag).
+
+    Общий для всех экземпляров счетчик в Redis (users:version)
+    увеличивается после каждого изменения, видимого в списке
+    пользователей: регистрации и подписки на бота.
+    """
+
+    KEY = 'users:version'
+
+    def __init__(self, redis: Redis):
+        self._redis = redis
+        self._bump = redis.register_script(BUMP_SCRIPT)
+
+    async def get(self) -> int:
+        version = await self._redis.get(self.KEY)
+        if version is None:
+            await self._redis.set(self.KEY, self._initial(), nx=True)
+            version = await self._redis.get(self.KEY)
+        return int(version)
+
+    async def bump(self) -> int:
+        return await self._bump(keys=[self.KEY], args=[self._initial()])
+
+    @staticmethod
+    def _initial() -> int:
+        return time.time_ns() // 1000
+
+
+users_version = UsersVersion(redis_client)
@@ -1,15 +1,12 @@
-import bcrypt, uuid
+import base64, logging, uuid
 
+from datetime import datetime
+from typing import Tuple
+from .protocol import OutgoingMessage
 from .websocket_manager import WebSocketPool
 
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """Проверка пароля."""
-
-    return bcrypt.checkpw(
-        plain_password.encode('utf-8'),
-        hashed_password.encode('utf-8')
-    )
+logger = logging.getLogger(__name__)
 
 
 def create_token() -> str:
@@ -18,18 +15,41 @@ def create_token() -> str:
     return str(uuid.uuid4())
 
 
+def encode_cursor(created_at: datetime, message_id: int) -> str:
+    """Кодирование позиции сообщения в курсор для постраничной выдачи."""
+
+    raw = f'{created_at.isoformat()}|{message_id}'
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Декодирование курсора в позицию сообщения (created_at, id).
+
+    При некорректном курсоре выбрасывается ValueError.
+    """
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        created_at, message_id = raw.split('|')
+        return datetime.fromisoformat(created_at), int(message_id)
+    except (UnicodeError, ValueError) as e:
+        raise ValueError(f'Некорректный курсор: {cursor}') from e
+
+
 async def send_message(
         user_id: int,
-        message: str,
+        message: OutgoingMessage,
         websocket_pool: WebSocketPool
-    ):
-    """Отправка сообщения всем активным подключениям пользователя."""
-
-    websockets = websocket_pool.connections[user_id]
-    
-    for websocket in websockets:
-        try:
-            print(f'Отправка сообщения пользователю {user_id}: {message}')
-            await websocket.send_text(message)
-        except Exception as e:
-            print(f'Ошибка при отправке сообщения пользователю {user_id}: {e}')
+    ) -> bool:
+    """Постановка сообщения в очереди всех подключений пользователя.
+
+    Возвращает False, если сообщение не поставлено ни в одну очередь.
+    """
+
+    delivered, failed = websocket_pool.broadcast([user_id], message)
+    if failed:
+        logger.warning(
+            'Сообщение не поставлено в очереди %d подключений', failed,
+            extra={'event': 'ws.send_failed', 'user_id': user_id}
+        )
+    return delivered > 0
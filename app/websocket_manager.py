@@ -1,55 +1,430 @@
 from starlette.websockets import WebSocketState
-import json
-from typing import List, Dict
+import asyncio, logging, time
+from collections import deque
+from typing import Any, List, Dict, Iterable, Optional, Set, Tuple
 from fastapi.websockets import WebSocket
 
+from .metrics import WS_FRAMES_OUT, WS_SEND_DURATION
+from .protocol import Frame, OutgoingMessage, json_codec, negotiate
+
+
+logger = logging.getLogger(__name__)
+
+
+class Connection:
+    """Подключение пользователя с собственной очередью исходящих кадров.
+
+    Кадры отправляет отдельная задача, поэтому постановка в очередь
+    не ждет медленного получателя. Обновления статусов не занимают место
+    в очереди: они схлопываются в один пакет (политика coalesce) или
+    отбрасываются, пока очередь выше high_water (политика drop).
+    Подключение, очередь которого дольше slow_consumer_timeout держится
+    выше high_water или достигла max_size, закрывается. Кадры кодируются
+    при отправке протоколом, согласованным с клиентом (codec).
+    """
+
+    def __init__(
+            self,
+            websocket: WebSocket,
+            user_id: int,
+            max_size: int = 1000,
+            high_water: int = 200,
+            slow_consumer_timeout: float = 10,
+            send_timeout: float = 5,
+            status_policy: str = 'coalesce',
+            codec=json_codec
+        ):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.codec = codec
+        self.closed = False
+        self._queue: deque = deque()
+        self._statuses: Dict[int, str] = {}
+        self._status_frame: Optional[Frame] = None
+        self._max_size = max_size
+        self._high_water = high_water
+        self._slow_consumer_timeout = slow_consumer_timeout
+        self._send_timeout = send_timeout
+        self._status_policy = status_policy
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._empty = asyncio.Event()
+        self._empty.set()
+        self._over_high_water_since: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+        self._close_task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self.closed = True
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def send(self, message: OutgoingMessage) -> bool:
+        """Постановка кадра в очередь без ожидания."""
+
+        if self.closed:
+            return False
+        if len(self._queue) >= self._max_size:
+            self.dropped += 1
+            self._evict('очередь переполнена')
+            return False
+        self._enqueue(message)
+        self._check_high_water()
+        return True
+
+    async def put(self, message: OutgoingMessage):
+        """Постановка кадра в очередь с ожиданием, пока она выше high_water.
+
+        Используется источниками, которые могут подождать
+        (например, досылка недоставленных сообщений).
+        """
+
+        while not self.closed and len(self._queue) >= self._high_water:
+            self._drained.clear()
+            await self._drained.wait()
+        if self.closed:
+            raise RuntimeError('Подключение закрыто')
+        self._enqueue(message)
+
+    async def wait_empty(self) -> bool:
+        """Ожидание отправки всех кадров очереди.
+
+        Возвращает False, если подключение закрылось раньше.
+        """
+
+        await self._empty.wait()
+        return not self.closed
+
+    def send_statuses(
+            self,
+            statuses: Dict[int, str],
+            frame: Optional[Frame] = None
+        ) -> bool:
+        """Постановка обновлений статусов согласно политике.
+
+        frame - общий для нескольких подключений кадр с теми же статусами,
+        он отправляется как есть, если до отправки статусы не изменятся.
+        """
+
+        if self.closed:
+            return False
+        if (
+            self._status_policy == 'drop' and
+            len(self._queue) >= self._high_water
+        ):
+            self.dropped += 1
+            return False
+        if not self._statuses and frame is not None:
+            self._statuses, self._status_frame = statuses, frame
+        else:
+            if self._status_frame is not None:
+                # Общий словарь статусов не изменяется, копия - своя
+                self._statuses = dict(self._statuses)
+                self._status_frame = None
+            self._statuses.update(statuses)
+        self._wakeup.set()
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'user_id': self.user_id,
+            'queue_depth': len(self._queue),
+            'pending_statuses': len(self._statuses),
+            'max_depth': self.max_depth,
+            'sent': self.sent,
+            'dropped': self.dropped,
+        }
+
+    def _enqueue(self, message: OutgoingMessage):
+        self._queue.append(message)
+        self._empty.clear()
+        self.max_depth = max(self.max_depth, len(self._queue))
+        self._wakeup.set()
+
+    def _check_high_water(self):
+        if len(self._queue) <= self._high_water:
+            return
+        now = time.monotonic()
+        if self._over_high_water_since is None:
+            self._over_high_water_since = now
+        elif now - self._over_high_water_since > self._slow_consumer_timeout:
+            self._evict('получатель не успевает принимать сообщения')
+
+    def _next_frame(self) -> Optional[OutgoingMessage]:
+        if self._queue:
+            message = self._queue.popleft()
+            if len(self._queue) < self._high_water:
+                self._over_high_water_since = None
+                self._drained.set()
+            return message
+        if self._statuses:
+            statuses, self._statuses = self._statuses, {}
+            frame, self._status_frame = self._status_frame, None
+            return frame or Frame({
+                'type': 'status_batch',
+                'statuses': statuses
+            })
+        return None
+
+    async def _run(self):
+        while not self.closed:
+            message = self._next_frame()
+            if message is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            if self.websocket.client_state != WebSocketState.CONNECTED:
+                self._evict('сокет не подключен')
+                return
+            try:
+                payload = self.codec.encode(message)
+                started_at = time.perf_counter()
+                await asyncio.wait_for(
+                    self.websocket.send_bytes(payload)
+                    if self.codec.binary
+                    else self.websocket.send_text(payload),
+                    self._send_timeout
+                )
+                WS_SEND_DURATION.observe(time.perf_counter() - started_at)
+                WS_FRAMES_OUT.inc()
+                self.sent += 1
+                if not self._queue:
+                    self._empty.set()
+            except Exception as e:
+                self._evict(f'ошибка отправки {e!r}')
+                return
+
+    def _evict(self, reason: str):
+        if self.closed:
+            return
+        logger.warning(
+            'Подключение закрыто: %s', reason,
+            extra={
+                'event': 'ws.evict',
+                'user_id': self.user_id,
+                'queue_depth': len(self._queue),
+            }
+        )
+        self.closed = True
+        self.dropped += len(self._queue)
+        self._queue.clear()
+        self._statuses = {}
+        self._status_frame = None
+        self._drained.set()
+        self._empty.set()
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+        self._close_task = asyncio.create_task(self._close_socket())
+
+    async def _close_socket(self):
+        try:
+            await asyncio.wait_for(
+                self.websocket.close(code=1013),
+                self._send_timeout
+            )
+        except Exception:
+            pass
+
 
 class WebSocketPool:
-    def __init__(self):
-        self.connections: Dict[int, List[WebSocket]] = {}
+    """Активные подключения экземпляра и рассылка статусов.
+
+    Клиент подписывается на статусы интересующих его пользователей.
+    Изменения статусов накапливаются и раз в flush_interval передаются
+    подписчикам одним пакетом на подключение через их очереди.
+    Рассылки кодируют кадр один раз на протокол и ставят его в очереди
+    всех получателей без ожидания.
+    """
+
+    def __init__(
+            self,
+            flush_interval: float = 0.5,
+            max_subscriptions: int = 1000,
+            **connection_options
+        ):
+        self.connections: Dict[int, List[Connection]] = {}
+        self._watchers: Dict[int, Set[Connection]] = {}
+        self._subscriptions: Dict[Connection, Set[int]] = {}
+        self._pending_statuses: Dict[int, str] = {}
+        self._flush_interval = flush_interval
+        self._max_subscriptions = max_subscriptions
+        self._connection_options = connection_options
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
 
-    async def connect(self, websocket: WebSocket, user_id: int):
-        await websocket.accept()
+    async def connect(self, websocket: WebSocket, user_id: int) -> Connection:
+        codec = negotiate(websocket.scope.get('subprotocols', []))
+        await websocket.accept(subprotocol=codec.subprotocol)
+        connection = Connection(
+            websocket, user_id, codec=codec, **self._connection_options
+        )
+        connection.start()
         if user_id not in self.connections:
             self.connections[user_id] = []
-        self.connections[user_id].append(websocket)
-        for other_user_id in self.connections:
-            if other_user_id != user_id:
-                status = 'online' if self.is_online(other_user_id) else 'offline'
-                await self.notify_user_status(other_user_id, status)
-            print(f'Подключенные пользователи: {self.connections}')
-
-    async def disconnect(self, user_id: int, websocket: WebSocket):
+        self.connections[user_id].append(connection)
+        return connection
+
+    async def disconnect(self, user_id: int, connection: Connection):
+        self.unsubscribe(connection)
+        await connection.stop()
         if user_id in self.connections:
-            if websocket in self.connections[user_id]:
-                self.connections[user_id].remove(websocket)
+            if connection in self.connections[user_id]:
+                self.connections[user_id].remove(connection)
             if not self.connections[user_id]:
-                await self.notify_user_status(user_id, 'offline')
                 del self.connections[user_id]
-                print(
-                    f'Пользователь {user_id} отключен. '
-                    f'Текущие подключения: {self.connections}'
-                )
-        print(f'Подключенные пользователи: {self.connections}')
 
     def is_online(self, user_id: int):
         return (
             user_id in self.connections and len(self.connections[user_id]) > 0
         )
 
+    def subscribe(self, connection: Connection, statuses: Dict[int, str]):
+        """Подписка подключения на статусы пользователей.
+
+        statuses - текущие статусы пользователей, они сразу
+        отправляются подписчику. Подписки сверх max_subscriptions
+        на подключение игнорируются.
+        """
+
+        subscriptions = self._subscriptions.setdefault(connection, set())
+        for user_id in statuses:
+            if len(subscriptions) >= self._max_subscriptions:
+                break
+            subscriptions.add(user_id)
+            self._watchers.setdefault(user_id, set()).add(connection)
+        if statuses:
+            connection.send_statuses(statuses)
+
+    def unsubscribe(
+            self,
+            connection: Connection,
+            user_ids: Optional[Iterable[int]] = None
+        ):
+        """Отписка подключения от статусов (по умолчанию от всех)."""
+
+        subscriptions = self._subscriptions.get(connection)
+        if not subscriptions:
+            self._subscriptions.pop(connection, None)
+            return
+        for user_id in list(subscriptions if user_ids is None else user_ids):
+            subscriptions.discard(user_id)
+            watchers = self._watchers.get(user_id)
+            if watchers is not None:
+                watchers.discard(connection)
+                if not watchers:
+                    del self._watchers[user_id]
+        if not subscriptions:
+            del self._subscriptions[connection]
+
     async def notify_user_status(self, user_id: int, status: str):
-        message = {
-        'type': 'status_update',
-        'user_id': user_id,
-        'status': status
-    }
-        for other_user_id, websockets in self.connections.items():
-            if other_user_id != user_id:
-                for websocket in websockets:
-                    if websocket.client_state == WebSocketState.CONNECTED:
-                        await websocket.send_text(json.dumps(message))
-                    else:
-                        print(
-                            f'WebSocket для пользователя {other_user_id} '
-                            f'не подключен, сообщение о статусе не отправлено.'
-                        )
+        """Постановка изменения статуса в очередь рассылки.
+
+        Повторные изменения статуса до рассылки схлопываются.
+        """
+
+        if user_id in self._watchers:
+            self._pending_statuses[user_id] = status
+
+    def broadcast(
+            self,
+            user_ids: Iterable[int],
+            message: OutgoingMessage
+        ) -> Tuple[int, int]:
+        """Рассылка кадра во все подключения пользователей.
+
+        Возвращает число подключений, в очереди которых кадр
+        поставлен, и число отказов.
+        """
+
+        if isinstance(message, str):
+            message = Frame(json_text=message)
+        delivered = failed = 0
+        for user_id in user_ids:
+            for connection in self.connections.get(user_id, ()):
+                if connection.send(message):
+                    delivered += 1
+                else:
+                    failed += 1
+        return delivered, failed
+
+    def flush(self) -> Tuple[int, int]:
+        """Передача накопленных изменений статусов подписчикам.
+
+        Подключения с одинаковым набором изменений получают общий кадр.
+        Возвращает число подключений, получивших изменения, и число
+        отказов.
+        """
+
+        pending, self._pending_statuses = self._pending_statuses, {}
+        diffs: Dict[Connection, Dict[int, str]] = {}
+        for user_id, status in pending.items():
+            for connection in self._watchers.get(user_id, ()):
+                diffs.setdefault(connection, {})[user_id] = status
+
+        frames: Dict[Tuple, Tuple[Dict[int, str], Frame]] = {}
+        delivered = failed = 0
+        for connection, statuses in diffs.items():
+            key = tuple(statuses.items())
+            if key not in frames:
+                frames[key] = statuses, Frame({
+                    'type': 'status_batch',
+                    'statuses': statuses
+                })
+            if connection.send_statuses(*frames[key]):
+                delivered += 1
+            else:
+                failed += 1
+        return delivered, failed
+
+    def stats(self) -> Dict[str, Any]:
+        """Показатели очередей подключений экземпляра."""
+
+        connections = [
+            connection.stats()
+            for user_connections in self.connections.values()
+            for connection in user_connections
+        ]
+        return {
+            'users': len(self.connections),
+            'connections': len(connections),
+            'queue_depth': sum(c['queue_depth'] for c in connections),
+            'max_queue_depth': max(
+                (c['queue_depth'] for c in connections), default=0
+            ),
+            # Распределение глубины очередей по подключениям
+            'connection_queue_depth': [c['queue_depth'] for c in connections],
+            'per_connection': connections,
+        }
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            if self._pending_statuses:
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.error(
+                        'Ошибка при рассылке статусов: %s', e,
+                        extra={'event': 'presence.flush_error'}
+                    )
@@ -0,0 +1,100 @@
+"""Сравнение сериализации страницы истории сообщений.
+
+Старый путь: объекты с атрибутами -> List[MessageBase] (pydantic)
+-> JSONResponse (стандартный json). Новый путь: строки выборки
+столбцов -> словари -> ORJSONResponse.
+
+Запуск из корня репозитория:
+    python -m benchmarks.history_serialization [--rows 10000]
+"""
+
+import argparse, json, timeit
+
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import List
+
+from fastapi.responses import JSONResponse, ORJSONResponse
+from pydantic import TypeAdapter
+
+from app.protocol import dumps
+from app.schemas import MessageBase
+
+
+MESSAGE_FIELDS = tuple(MessageBase.model_fields)
+
+
+def make_rows(count: int):
+    started_at = datetime(2024, 1, 1)
+    return [
+        (
+            1 + i % 2,
+            2 - i % 2,
+            f'Сообщение номер {i} с обычным для чата текстом',
+            started_at + timedelta(seconds=i, microseconds=i),
+            i + 1,
+        )
+        for i in range(count)
+    ]
+
+
+def pydantic_json(objects, adapter: TypeAdapter) -> bytes:
+    # Так сериализует ответ FastAPI при заданном response_model
+    validated = adapter.validate_python(objects)
+    return JSONResponse(adapter.dump_python(validated, mode='json')).body
+
+
+def projected_orjson(rows) -> bytes:
+    return ORJSONResponse(
+        [dict(zip(MESSAGE_FIELDS, row)) for row in rows]
+    ).body
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    objects = [
+        SimpleNamespace(**dict(zip(MESSAGE_FIELDS + ('id',), row)))
+        for row in rows
+    ]
+    adapter = TypeAdapter(List[MessageBase])
+
+    assert (
+        json.loads(pydantic_json(objects, adapter)) ==
+        json.loads(projected_orjson(rows))
+    )
+
+    cases = {
+        'pydantic + json': lambda: pydantic_json(objects, adapter),
+        'columns + orjson': lambda: projected_orjson(rows),
+    }
+    results = {}
+    print(f'Страница истории: {args.rows} сообщений')
+    for name, func in cases.items():
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        results[name] = best
+        print(f'  {name:<20} {best * 1000:8.2f} мс')
+    print(
+        f'  ускорение: '
+        f'{results["pydantic + json"] / results["columns + orjson"]:.1f}x'
+    )
+
+    statuses = {user_id: 'online' for user_id in range(1000)}
+    frame = {'type': 'status_batch', 'statuses': statuses}
+    stdlib = min(timeit.repeat(
+        lambda: json.dumps(frame), number=100, repeat=5
+    )) / 100
+    fast = min(timeit.repeat(
+        lambda: dumps(frame), number=100, repeat=5
+    )) / 100
+    print('Пакет статусов на 1000 пользователей')
+    print(f'  {"json.dumps":<20} {stdlib * 1e6:8.1f} мкс')
+    print(f'  {"orjson":<20} {fast * 1e6:8.1f} мкс')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,448 @@
+"""Нагрузочный прогон сервера чата.
+
+Клиенты проходят регистрацию и вход, подключаются по WebSocket,
+обмениваются сообщениями и читают историю. Сценарии:
+
+    chat           - каждый пользователь пишет соседу, затем читает историю;
+    connect-storm  - одновременное подключение всех пользователей;
+    backlog        - досылка накопленных сообщений при подключении;
+    fanout         - рассылка статуса одного пользователя всем подписчикам.
+
+Отчет: пропускная способность, задержки доставки p50/p95/p99
+и прирост памяти сервера на одно соединение (по VmRSS, если процесс
+сервера известен).
+
+Без --url запускается стенд benchmarks.standin (sqlite + fakeredis).
+Запуск из корня репозитория:
+    python -m benchmarks.load [--users 200] [--messages 20]
+        [--scenarios chat,connect-storm,backlog,fanout] [--json report.json]
+"""
+
+import argparse, asyncio, json, os, socket, statistics, subprocess, sys, time
+import uuid
+
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+
+SCENARIOS = ('chat', 'connect-storm', 'backlog', 'fanout')
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    """p50/p95/p99 и максимум в миллисекундах."""
+
+    if not values:
+        return {}
+    if len(values) == 1:
+        cuts = values * 99
+    else:
+        cuts = statistics.quantiles(values, n=100, method='inclusive')
+    return {
+        'p50_ms': round(cuts[49] * 1000, 2),
+        'p95_ms': round(cuts[94] * 1000, 2),
+        'p99_ms': round(cuts[98] * 1000, 2),
+        'max_ms': round(max(values) * 1000, 2),
+    }
+
+
+def read_rss(pid: Optional[int]) -> Optional[int]:
+    """Резидентная память процесса в байтах (только Linux)."""
+
+    if pid is None:
+        return None
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class StandIn:
+    """Стенд сервера в отдельном процессе."""
+
+    def __init__(self, port: int, env: Optional[Dict[str, str]] = None):
+        self.port = port
+        self.env = env
+        self.url = f'http://127.0.0.1:{port}'
+        self.process: Optional[subprocess.Popen] = None
+
+    async def __aenter__(self) -> 'StandIn':
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'benchmarks.standin',
+             '--port', str(self.port)],
+            env={**os.environ, **(self.env or {})}
+        )
+        async with aiohttp.ClientSession() as session:
+            for _ in range(300):
+                if self.process.poll() is not None:
+                    raise RuntimeError('Стенд завершился при запуске')
+                try:
+                    async with session.get(f'{self.url}/metrics') as response:
+                        if response.status == 200:
+                            return self
+                except aiohttp.ClientError:
+                    pass
+                await asyncio.sleep(0.1)
+        raise RuntimeError('Стенд не запустился')
+
+    async def __aexit__(self, *exc_info):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+class LoadRunner:
+
+    def __init__(
+            self,
+            session: aiohttp.ClientSession,
+            url: str,
+            server_pid: Optional[int],
+            timeout: float
+        ):
+        self.session = session
+        self.url = url.rstrip('/')
+        self.ws_url = 'ws' + self.url[len('http'):]
+        self.server_pid = server_pid
+        self.timeout = timeout
+        self.run_id = uuid.uuid4().hex[:8]
+        self.users: List[Dict[str, Any]] = []
+
+    async def create_users(self, count: int) -> Dict[str, Any]:
+        """Регистрация и вход count пользователей."""
+
+        async def create(index: int) -> Dict[str, Any]:
+            credentials = {
+                'username': f'load-{self.run_id}-{index}',
+                'password': 'load-password',
+            }
+            async with self.session.post(
+                f'{self.url}/api/registration',
+                json={**credentials,
+                      'tg_username': credentials['username'],
+                      'is_subscribed_to_bot': False}
+            ) as response:
+                response.raise_for_status()
+            async with self.session.post(
+                f'{self.url}/api/login', json=credentials
+            ) as response:
+                response.raise_for_status()
+                return await response.json()
+
+        started_at = time.perf_counter()
+        self.users = await asyncio.gather(*map(create, range(count)))
+        elapsed = time.perf_counter() - started_at
+        return {
+            'users': count,
+            'seconds': round(elapsed, 3),
+            'registrations_per_second': round(count / elapsed, 1),
+        }
+
+    async def connect(self, user: Dict[str, Any]):
+        return await self.session.ws_connect(
+            f'{self.ws_url}/api/ws/{user["id"]}', heartbeat=None
+        )
+
+    async def chat(self, messages: int) -> Dict[str, Any]:
+        """Каждый пользователь отправляет messages сообщений соседу."""
+
+        users = self.users
+        sockets = await asyncio.gather(*map(self.connect, users))
+        expected = len(users) * messages
+        latencies: List[float] = []
+        done = asyncio.Event()
+        marker = f'{self.run_id}:'
+
+        async def receive(ws):
+            async for frame in ws:
+                if frame.type != aiohttp.WSMsgType.TEXT:
+                    break
+                data = json.loads(frame.data)
+                content = data.get('content', '')
+                if content.startswith(marker):
+                    latencies.append(
+                        time.perf_counter() - float(content.split(':')[1])
+                    )
+                    if len(latencies) == expected:
+                        done.set()
+
+        async def send(index: int, ws):
+            receiver_id = users[(index + 1) % len(users)]['id']
+            for _ in range(messages):
+                await ws.send_str(json.dumps({
+                    'receiver_id': receiver_id,
+                    'content': f'{marker}{time.perf_counter()}',
+                }))
+                await asyncio.sleep(0)
+
+        readers = [asyncio.create_task(receive(ws)) for ws in sockets]
+        started_at = time.perf_counter()
+        await asyncio.gather(*(
+            send(index, ws) for index, ws in enumerate(sockets)
+        ))
+        try:
+            await asyncio.wait_for(done.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            pass
+        elapsed = time.perf_counter() - started_at
+
+        for ws in sockets:
+            await ws.close()
+        for reader in readers:
+            reader.cancel()
+
+        history = await self.read_history()
+        return {
+            'sent': expected,
+            'delivered': len(latencies),
+            'seconds': round(elapsed, 3),
+            'messages_per_second': round(len(latencies) / elapsed, 1),
+            'delivery': percentiles(latencies),
+            'history': history,
+        }
+
+    async def read_history(self) -> Dict[str, Any]:
+        """Чтение последней страницы истории каждым пользователем."""
+
+        users = self.users
+        latencies: List[float] = []
+
+        async def read(index: int):
+            user = users[index]
+            peer_id = users[(index + 1) % len(users)]['id']
+            started_at = time.perf_counter()
+            async with self.session.get(
+                f'{self.url}/api/messages/{peer_id}',
+                params={'limit': 50},
+                headers={'Authorization': f'Token {user["auth_token"]}'}
+            ) as response:
+                response.raise_for_status()
+                await response.read()
+            latencies.append(time.perf_counter() - started_at)
+
+        started_at = time.perf_counter()
+        await asyncio.gather(*map(read, range(len(users))))
+        elapsed = time.perf_counter() - started_at
+        return {
+            'requests': len(users),
+            'requests_per_second': round(len(users) / elapsed, 1),
+            'latency': percentiles(latencies),
+        }
+
+    async def connect_storm(self) -> Dict[str, Any]:
+        """Одновременное подключение всех пользователей."""
+
+        latencies: List[float] = []
+
+        async def connect(user):
+            started_at = time.perf_counter()
+            ws = await self.connect(user)
+            latencies.append(time.perf_counter() - started_at)
+            return ws
+
+        rss_before = read_rss(self.server_pid)
+        started_at = time.perf_counter()
+        sockets = await asyncio.gather(*map(connect, self.users))
+        elapsed = time.perf_counter() - started_at
+        # Даем серверу разослать статусы и досылки
+        await asyncio.sleep(1)
+        rss_after = read_rss(self.server_pid)
+
+        for ws in sockets:
+            await ws.close()
+
+        report = {
+            'connections': len(sockets),
+            'seconds': round(elapsed, 3),
+            'connections_per_second': round(len(sockets) / elapsed, 1),
+            'connect': percentiles(latencies),
+        }
+        if rss_before is not None and rss_after is not None:
+            report['memory_per_connection_bytes'] = (
+                (rss_after - rss_before) // len(sockets)
+            )
+        return report
+
+    async def backlog(self, messages: int) -> Dict[str, Any]:
+        """Досылка messages сообщений, накопленных для оффлайн-получателя."""
+
+        sender, receiver = self.users[0], self.users[1]
+        marker = f'{self.run_id}-backlog:'
+        ws = await self.connect(sender)
+        for index in range(messages):
+            await ws.send_str(json.dumps({
+                'receiver_id': receiver['id'],
+                'content': f'{marker}{index}',
+            }))
+        await ws.close()
+        # Сообщения ставятся в очередь при обработке, ждем ее окончания
+        await asyncio.sleep(1)
+
+        started_at = time.perf_counter()
+        ws = await self.connect(receiver)
+        received = 0
+        truncated = 0
+        first_at = None
+        try:
+            async with asyncio.timeout(self.timeout):
+                async for frame in ws:
+                    data = json.loads(frame.data)
+                    if data.get('type') == 'backlog_truncated':
+                        truncated = data['count']
+                    elif data.get('content', '').startswith(marker):
+                        received += 1
+                        if first_at is None:
+                            first_at = time.perf_counter() - started_at
+                    if received + truncated >= messages:
+                        break
+        except TimeoutError:
+            pass
+        elapsed = time.perf_counter() - started_at
+        await ws.close()
+
+        return {
+            'queued': messages,
+            'replayed': received,
+            'truncated': truncated,
+            'seconds': round(elapsed, 3),
+            'first_message_ms': round((first_at or 0) * 1000, 2),
+            'messages_per_second': round(received / elapsed, 1),
+        }
+
+    async def fanout(self) -> Dict[str, Any]:
+        """Рассылка статуса online одного пользователя всем остальным."""
+
+        target, watchers = self.users[0], self.users[1:]
+        target_id = str(target['id'])
+        sockets = await asyncio.gather(*map(self.connect, watchers))
+        subscribed = 0
+        for ws in sockets:
+            await ws.send_str(json.dumps({
+                'type': 'presence_subscribe', 'user_ids': [target['id']]
+            }))
+        # Первый пакет статусов (offline) подтверждает подписку
+        for ws in sockets:
+            async for frame in ws:
+                statuses = json.loads(frame.data).get('statuses', {})
+                if target_id in statuses:
+                    subscribed += 1
+                    break
+
+        latencies: List[float] = []
+
+        async def wait_online(ws):
+            async for frame in ws:
+                statuses = json.loads(frame.data).get('statuses', {})
+                if statuses.get(target_id) == 'online':
+                    latencies.append(time.perf_counter() - started_at)
+                    return
+
+        waiters = [asyncio.create_task(wait_online(ws)) for ws in sockets]
+        started_at = time.perf_counter()
+        target_ws = await self.connect(target)
+        await asyncio.wait(waiters, timeout=self.timeout)
+        elapsed = time.perf_counter() - started_at
+
+        for waiter in waiters:
+            waiter.cancel()
+        await target_ws.close()
+        for ws in sockets:
+            await ws.close()
+
+        return {
+            'watchers': len(watchers),
+            'subscribed': subscribed,
+            'notified': len(latencies),
+            'seconds': round(elapsed, 3),
+            'delivery': percentiles(latencies),
+        }
+
+
+def print_report(report: Dict[str, Any], indent: int = 0):
+    for key, value in report.items():
+        if isinstance(value, dict):
+            print(f'{" " * indent}{key}:')
+            print_report(value, indent + 2)
+        else:
+            print(f'{" " * indent}{key}: {value}')
+
+
+async def run(args) -> Dict[str, Any]:
+    report: Dict[str, Any] = {}
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=args.timeout)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(
+        timeout=timeout, connector=connector
+    ) as session:
+        runner = LoadRunner(session, args.url, args.server_pid, args.timeout)
+        report['setup'] = await runner.create_users(args.users)
+        for scenario in args.scenarios:
+            if scenario == 'chat':
+                report[scenario] = await runner.chat(args.messages)
+            elif scenario == 'connect-storm':
+                report[scenario] = await runner.connect_storm()
+            elif scenario == 'backlog':
+                report[scenario] = await runner.backlog(args.backlog)
+            elif scenario == 'fanout':
+                report[scenario] = await runner.fanout()
+            # Отключения обрабатываются сервером асинхронно
+            await asyncio.sleep(0.5)
+    return report
+
+
+async def run_with_standin(args) -> Dict[str, Any]:
+    async with StandIn(free_port()) as standin:
+        args.url = standin.url
+        args.server_pid = standin.process.pid
+        return await run(args)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default=None,
+                        help='адрес сервера; без него запускается стенд')
+    parser.add_argument('--server-pid', type=int, default=None,
+                        help='pid сервера для замера памяти')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=20,
+                        help='сообщений на пользователя в сценарии chat')
+    parser.add_argument('--backlog', type=int, default=500,
+                        help='сообщений в сценарии backlog')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--json', default=None,
+                        help='файл для отчета в формате JSON')
+    args = parser.parse_args()
+
+    args.scenarios = [name.strip() for name in args.scenarios.split(',')]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'неизвестные сценарии: {", ".join(sorted(unknown))}')
+    if args.users < 2:
+        parser.error('нужно не меньше двух пользователей')
+
+    if args.url:
+        report = asyncio.run(run(args))
+    else:
+        report = asyncio.run(run_with_standin(args))
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
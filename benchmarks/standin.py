@@ -0,0 +1,51 @@
+"""Стенд сервера чата без postgres и Redis.
+
+Приложение запускается целиком (uvicorn, пул WebSocket, запись
+сообщений, кластер, очередь недоставленных), но база данных - файл
+sqlite, а Redis - fakeredis в памяти процесса. Стенд нужен для
+воспроизводимых нагрузочных прогонов на машине разработчика и в CI.
+
+Запуск из корня репозитория:
+    python -m benchmarks.standin [--port 8000] [--db /tmp/chat.db]
+"""
+
+import argparse, os, tempfile
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--db', default=None)
+    args = parser.parse_args()
+
+    db_path = args.db or os.path.join(
+        tempfile.mkdtemp(prefix='chat-standin-'), 'chat.db'
+    )
+    for name in ('POSTGRES_NAME', 'POSTGRES_USER', 'POSTGRES_PASS',
+                 'POSTGRES_HOST', 'POSTGRES_PORT'):
+        os.environ.setdefault(name, 'standin')
+    os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+    os.environ['ASYNC_DATABASE_URL'] = f'sqlite+aiosqlite:///{db_path}'
+    # Стоимость bcrypt не относится к измеряемому пути
+    os.environ.setdefault('BCRYPT_ROUNDS', '4')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+    # Клиент Redis создается при импорте app.database
+    import fakeredis, redis.asyncio
+    server = fakeredis.FakeServer()
+    redis.asyncio.from_url = lambda url, **kwargs: fakeredis.FakeAsyncRedis(
+        server=server, **kwargs
+    )
+
+    import uvicorn
+
+    from app.database import Base, engine
+    from app.main import app
+
+    Base.metadata.create_all(engine)
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+"""Стресс-тест: много открытых WebSocket при малом пуле базы данных.
+
+Стенд запускается с пулом асинхронного движка из --pool-size соединений
+без переполнения. Открываются --connections подключений, распределенных
+между зарегистрированными пользователями; пока они открыты, пользователи
+обмениваются сообщениями и читают историю. Состояние пула снимается
+с /metrics в течение всего прогона.
+
+Проверяется, что все подключения открыты, все сообщения доставлены,
+а соединений с базой занято не больше размера пула.
+
+Запуск из корня репозитория:
+    python -m benchmarks.ws_connections [--connections 10000] [--pool-size 5]
+"""
+
+import argparse, asyncio, json, resource, sys, time
+
+from typing import Any, Dict, List
+
+import aiohttp
+
+from benchmarks.load import (LoadRunner,
+                             StandIn,
+                             free_port,
+                             percentiles,
+                             print_report,
+                             read_rss)
+
+
+def parse_metrics(text: str) -> Dict[str, float]:
+    """Значения метрик по имени (без учета меток)."""
+
+    values: Dict[str, float] = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        name, _, value = line.rpartition(' ')
+        name = name.split('{', 1)[0]
+        values[name] = values.get(name, 0) + float(value)
+    return values
+
+
+class PoolWatcher:
+    """Периодический опрос /metrics с учетом пиковых значений пула."""
+
+    def __init__(self, session: aiohttp.ClientSession, url: str):
+        self.session = session
+        self.url = url
+        self.peak_checked_out = 0.0
+        self.peak_open = 0.0
+        self.last: Dict[str, float] = {}
+
+    async def scrape(self) -> Dict[str, float]:
+        async with self.session.get(f'{self.url}/metrics') as response:
+            self.last = parse_metrics(await response.text())
+        checked_out = self.last.get('db_pool_async_checked_out', 0)
+        self.peak_checked_out = max(self.peak_checked_out, checked_out)
+        self.peak_open = max(
+            self.peak_open,
+            checked_out + self.last.get('db_pool_async_idle', 0)
+        )
+        return self.last
+
+    async def run(self, interval: float):
+        while True:
+            await self.scrape()
+            await asyncio.sleep(interval)
+
+
+def raise_file_limit(required: int):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < required:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        soft = hard
+    if soft < required:
+        print(
+            f'Предел открытых файлов {soft} меньше {required}, '
+            f'часть подключений может не открыться',
+            file=sys.stderr
+        )
+
+
+async def run(args, url: str, server_pid: int) -> Dict[str, Any]:
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=args.timeout)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(
+        timeout=timeout, connector=connector
+    ) as session:
+        runner = LoadRunner(session, url, server_pid, args.timeout)
+        await runner.create_users(args.users)
+        users = runner.users
+        watcher = PoolWatcher(session, url)
+        watcher_task = asyncio.create_task(watcher.run(0.2))
+
+        # Подключения открываются волнами, чтобы не упереться в backlog
+        # слушающего сокета
+        semaphore = asyncio.Semaphore(args.concurrency)
+        sockets: List[List[aiohttp.ClientWebSocketResponse]] = [
+            [] for _ in users
+        ]
+        readers: List[asyncio.Task] = []
+        latencies: List[float] = []
+        expected = 0
+        done = asyncio.Event()
+        marker = f'{runner.run_id}:'
+        failed = 0
+
+        async def receive(ws):
+            # Чтение начинается сразу после подключения: клиент отвечает
+            # на ping сервера только при чтении
+            async for frame in ws:
+                if frame.type != aiohttp.WSMsgType.TEXT:
+                    break
+                content = json.loads(frame.data).get('content', '')
+                if content.startswith(marker):
+                    latencies.append(
+                        time.perf_counter() - float(content.split(':')[1])
+                    )
+                    if len(latencies) == expected:
+                        done.set()
+
+        async def connect(index: int):
+            nonlocal failed
+            user_index = index % len(users)
+            async with semaphore:
+                try:
+                    ws = await runner.connect(users[user_index])
+                except (aiohttp.ClientError, OSError):
+                    failed += 1
+                    return
+            sockets[user_index].append(ws)
+            readers.append(asyncio.create_task(receive(ws)))
+
+        rss_before = read_rss(server_pid)
+        started_at = time.perf_counter()
+        await asyncio.gather(*map(connect, range(args.connections)))
+        connect_seconds = time.perf_counter() - started_at
+        opened = sum(map(len, sockets))
+
+        # Каждое сообщение доставляется во все подключения получателя
+        expected = sum(
+            args.messages * len(sockets[(index + 1) % len(users)])
+            for index in range(len(users))
+        )
+
+        async def send(index: int):
+            if not sockets[index]:
+                return
+            receiver_id = users[(index + 1) % len(users)]['id']
+            for _ in range(args.messages):
+                await sockets[index][0].send_str(json.dumps({
+                    'receiver_id': receiver_id,
+                    'content': f'{marker}{time.perf_counter()}',
+                }))
+
+        await asyncio.gather(*map(send, range(len(users))))
+        try:
+            await asyncio.wait_for(done.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        history = await runner.read_history()
+        metrics = await watcher.scrape()
+        rss_after = read_rss(server_pid)
+
+        watcher_task.cancel()
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*(
+            ws.close() for user_sockets in sockets for ws in user_sockets
+        ))
+
+    report: Dict[str, Any] = {
+        'connections': {
+            'requested': args.connections,
+            'opened': opened,
+            'failed': failed,
+            'server_reported': int(
+                metrics.get('websocket_pool_connections', 0)
+            ),
+            'seconds': round(connect_seconds, 3),
+        },
+        'delivery': {
+            'expected': expected,
+            'delivered': len(latencies),
+            **percentiles(latencies),
+        },
+        'history': history,
+        'db_pool': {
+            'size': int(metrics.get('db_pool_async_size', 0)),
+            'peak_checked_out': int(watcher.peak_checked_out),
+            'peak_open': int(watcher.peak_open),
+            'overflow': int(metrics.get('db_pool_async_overflow', 0)),
+        },
+    }
+    if rss_before is not None and rss_after is not None and opened:
+        report['connections']['memory_per_connection_bytes'] = (
+            (rss_after - rss_before) // opened
+        )
+    return report
+
+
+async def run_with_standin(args) -> Dict[str, Any]:
+    env = {
+        'DB_POOL_SIZE': str(args.pool_size),
+        'DB_MAX_OVERFLOW': '0',
+        'SYNC_DB_POOL_SIZE': str(args.pool_size),
+    }
+    async with StandIn(free_port(), env) as standin:
+        return await run(args, standin.url, standin.process.pid)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=5)
+    parser.add_argument('--pool-size', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=500,
+                        help='одновременно открываемых подключений')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--json', default=None)
+    args = parser.parse_args()
+
+    raise_file_limit(args.connections + 1024)
+    report = asyncio.run(run_with_standin(args))
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(report, output, indent=2)
+
+    ok = (
+        report['connections']['opened'] == args.connections and
+        report['delivery']['delivered'] == report['delivery']['expected'] and
+        report['db_pool']['peak_open'] <= args.pool_size
+    )
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
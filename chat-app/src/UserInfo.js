@@ -2,6 +2,18 @@ import React, { useContext, useEffect, useState } from 'react';
 import { useNavigate } from 'react-router-dom';
 import { WebSocketContext } from './WebSocketProvider';
 
+const HISTORY_PAGE_SIZE = 50;
+
+// Отметка о прочтении диалога на сервере
+const markRead = (receiverId) => {
+    fetch(`http://localhost:8000/api/conversations/${receiverId}/read`, {
+        method: 'POST',
+        headers: {
+            'Authorization': `Token ${localStorage.getItem('authToken')}`
+        }
+    }).catch(() => {});
+};
+
 const UserInfo = () => {
     const navigate = useNavigate();
     const { ws } = useContext(WebSocketContext);
@@ -12,6 +24,7 @@ const UserInfo = () => {
     const [receiverStatus, setReceiverStatus] = useState('offline');
     const [loadingMessages, setLoadingMessages] = useState(false);
     const [messages, setMessages] = useState([]);
+    const [historyCursor, setHistoryCursor] = useState(null);
 
     useEffect(() => {
         const authToken = localStorage.getItem('authToken');
@@ -26,7 +39,20 @@ const UserInfo = () => {
         }
 
         const receiver = JSON.parse(localStorage.getItem('receiver'));
+        // Пока чат открыт, входящие сообщения собеседника считаются
+        // прочитанными: отметка отправляется не чаще раза в секунду
+        let readTimer = null;
+        const scheduleMarkRead = () => {
+            if (!readTimer) {
+                readTimer = setTimeout(() => {
+                    readTimer = null;
+                    markRead(receiver.id);
+                }, 1000);
+            }
+        };
+
         if (receiver) {
+            markRead(receiver.id);
             setReceiverName(receiver.username);
             const savedStatuses = JSON.parse(localStorage.getItem('userStatuses')) || {};
             setReceiverStatus(savedStatuses[receiver.id] || 'offline');
@@ -44,16 +70,23 @@ const UserInfo = () => {
         const handleIncomingMessage = (event) => {
             const data = JSON.parse(event.data);
 
-            if (data.type === "status_update") {
-                const { user_id, status } = data;
-                if (user_id === receiver.id) {
+            if (data.type === "status_batch") {
+                const status = data.statuses[receiver.id];
+                if (status) {
                     setReceiverStatus(status);
                     const savedStatuses = JSON.parse(localStorage.getItem('userStatuses')) || {};
-                    const updatedStatuses = { ...savedStatuses, [user_id]: status };
+                    const updatedStatuses = { ...savedStatuses, [receiver.id]: status };
                     localStorage.setItem('userStatuses', JSON.stringify(updatedStatuses));
                 }
-            } else {
+            } else if (data.type === 'backlog_truncated') {
+                // Часть недоставленных сообщений отброшена, они остаются
+                // в истории на сервере
+                console.warn(`Пропущено недоставленных сообщений: ${data.count}`);
+            } else if (data.content !== undefined) {
                 setIncomingMessages((prevMessages) => [data, ...prevMessages]);
+                if (data.sender_id === receiver.id) {
+                    scheduleMarkRead();
+                }
 
                 const receiverId = receiver.id;
                 const messages = JSON.parse(localStorage.getItem(`messages_${receiverId}`)) || [];
@@ -71,11 +104,21 @@ const UserInfo = () => {
                 user_id: currentUser.id,
                 status: 'online'
             }));
+            if (receiver) {
+                ws.send(JSON.stringify({
+                    type: 'presence_subscribe',
+                    user_ids: [receiver.id]
+                }));
+            }
 
             ws.addEventListener('message', handleIncomingMessage);
         }
 
         return () => {
+            if (readTimer) {
+                clearTimeout(readTimer);
+                markRead(receiver.id);
+            }
             if (ws && ws.readyState === WebSocket.OPEN) {
                 ws.removeEventListener('message', handleIncomingMessage);
             }
@@ -107,12 +150,18 @@ const UserInfo = () => {
         }
     };
 
-    const handleLoadMessages = async () => {
+    // История выдается страницами от новых к старым: курсор более
+    // ранней страницы приходит в заголовке X-Prev-Cursor
+    const handleLoadMessages = async (older = false) => {
         setLoadingMessages(true);
         const receiverId = JSON.parse(localStorage.getItem('receiver')).id;
+        const params = new URLSearchParams({ limit: HISTORY_PAGE_SIZE });
+        if (older && historyCursor) {
+            params.set('before', historyCursor);
+        }
 
         try {
-            const response = await fetch(`http://localhost:8000/api/messages/${receiverId}`, {
+            const response = await fetch(`http://localhost:8000/api/messages/${receiverId}?${params}`, {
                 method: 'GET',
                 headers: {
                     'Authorization': `Token ${localStorage.getItem('authToken')}`,
@@ -125,7 +174,11 @@ const UserInfo = () => {
             }
 
             const data = await response.json();
-            setMessages(data);
+            setMessages((prevMessages) => older ? [...data, ...prevMessages] : data);
+            // Неполная страница - более ранних сообщений нет
+            setHistoryCursor(
+                data.length === HISTORY_PAGE_SIZE ? response.headers.get('X-Prev-Cursor') : null
+            );
         } catch (error) {
             console.error('Ошибка при загрузке сообщений:', error);
         } finally {
@@ -198,9 +251,14 @@ const UserInfo = () => {
                 </div>
             )}
 
-            <button onClick={handleLoadMessages} style={{ marginTop: '20px' }}>
+            <button onClick={() => handleLoadMessages()} style={{ marginTop: '20px' }}>
                 Загрузить историю сообщений
             </button>
+            {historyCursor && (
+                <button onClick={() => handleLoadMessages(true)} disabled={loadingMessages} style={{ marginTop: '20px', marginLeft: '10px' }}>
+                    Загрузить более ранние сообщения
+                </button>
+            )}
         </div>
     );
 };
@@ -24,20 +24,44 @@ const Users = () => {
         const fetchUsers = async () => {
             const baseURL = 'http://localhost:8000/api';
             try {
-                const response = await axios.get(`${baseURL}/users`, {
-                    headers: {
-                        Authorization: `Token ${authToken}`
-                    }
-                });
-                setUsers(response.data);
+                // Список выдается страницами, курсор следующей - в X-Next-Cursor
+                let loadedUsers = [];
+                let cursor = null;
+                do {
+                    const response = await axios.get(`${baseURL}/users`, {
+                        headers: {
+                            Authorization: `Token ${authToken}`
+                        },
+                        params: cursor ? { after: cursor, limit: 1000 } : { limit: 1000 }
+                    });
+                    loadedUsers = loadedUsers.concat(response.data);
+                    cursor = response.headers['x-next-cursor'];
+                } while (cursor);
+                setUsers(loadedUsers);
 
                 const savedStatuses = JSON.parse(localStorage.getItem('userStatuses')) || {};
                 const initialStatuses = {};
-                response.data.forEach(user => {
+                loadedUsers.forEach(user => {
                     initialStatuses[user.id] = savedStatuses[user.id] || 'offline';
                 });
                 setUserStatuses(initialStatuses);
+                // Непрочитанные сообщения по сводкам диалогов (тоже страницами)
                 const savedNewMessages = JSON.parse(localStorage.getItem('newMessages')) || {};
+                let conversationsCursor = null;
+                do {
+                    const conversations = await axios.get(`${baseURL}/conversations`, {
+                        headers: {
+                            Authorization: `Token ${authToken}`
+                        },
+                        params: conversationsCursor ? { before: conversationsCursor, limit: 200 } : { limit: 200 }
+                    });
+                    conversations.data.forEach(conversation => {
+                        if (conversation.unread_count > 0) {
+                            savedNewMessages[conversation.peer_id] = true;
+                        }
+                    });
+                    conversationsCursor = conversations.headers['x-next-cursor'];
+                } while (conversationsCursor);
                 setNewMessages(savedNewMessages);
             } catch (error) {
                 setError(error.response?.data?.detail || 'Ошибка при загрузке пользователей');
@@ -52,10 +76,9 @@ const Users = () => {
             const data = JSON.parse(event.data);
             console.log('Получено сообщение:', data);
 
-            if (data.type === "status_update") {
-                const { user_id, status } = data;
+            if (data.type === "status_batch") {
                 setUserStatuses(prevStatuses => {
-                    const updatedStatuses = { ...prevStatuses, [user_id]: status };
+                    const updatedStatuses = { ...prevStatuses, ...data.statuses };
                     const filteredStatuses = { ...updatedStatuses };
                     delete filteredStatuses[currentUser.id];
                     localStorage.setItem('userStatuses', JSON.stringify(filteredStatuses));
@@ -86,6 +109,30 @@ const Users = () => {
         };
     }, [navigate, ws]);
 
+    useEffect(() => {
+        if (!ws || users.length === 0) {
+            return;
+        }
+
+        // Подписка на статусы пользователей из списка
+        const subscribe = () => {
+            ws.send(JSON.stringify({
+                type: 'presence_subscribe',
+                user_ids: users.map(user => user.id)
+            }));
+        };
+
+        if (ws.readyState === WebSocket.OPEN) {
+            subscribe();
+        } else {
+            ws.addEventListener('open', subscribe);
+        }
+
+        return () => {
+            ws.removeEventListener('open', subscribe);
+        };
+    }, [ws, users]);
+
     const handleUserClick = (userId) => {
         const selectedUser = users.find(user => user.id === userId);
         if (selectedUser) {
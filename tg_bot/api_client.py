@@ -0,0 +1,263 @@
+import asyncio, aiohttp, json, logging, os, time
+
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+User = Dict[str, Any]
+
+
+class UserCache:
+    """Небольшой кэш пользователей по нику в телеге со сроком жизни."""
+
+    def __init__(self, ttl: float, max_size: int):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._entries: Dict[str, Tuple[float, Optional[User]]] = {}
+
+    def get(self, tg_username: str) -> Tuple[bool, Optional[User]]:
+        entry = self._entries.get(tg_username)
+        if entry is None:
+            return False, None
+        expires_at, user = entry
+        if expires_at <= time.monotonic():
+            del self._entries[tg_username]
+            return False, None
+        return True, user
+
+    def set(self, tg_username: str, user: Optional[User]):
+        if len(self._entries) >= self._max_size:
+            now = time.monotonic()
+            self._entries = {
+                key: entry
+                for key, entry in self._entries.items()
+                if entry[0] > now
+            }
+            if len(self._entries) >= self._max_size:
+                self._entries.pop(next(iter(self._entries)))
+        self._entries[tg_username] = (time.monotonic() + self._ttl, user)
+
+    def invalidate(self, tg_username: str):
+        self._entries.pop(tg_username, None)
+
+
+class ApiClient:
+    """Клиент API чата для бота.
+
+    Одна сессия aiohttp с пулом keep-alive соединений на процесс
+    (после fork создается заново), таймауты на запрос и повтор
+    с экспоненциальной задержкой при сетевых ошибках и ответах 5xx.
+    Пользователи по нику в телеге кэшируются на cache_ttl секунд,
+    список подписчиков - до изменения его ETag.
+    """
+
+    def __init__(
+            self,
+            api_url: str,
+            timeout: float = 5,
+            retries: int = 3,
+            backoff: float = 0.2,
+            pool_size: int = 20,
+            cache_ttl: float = 30,
+            cache_size: int = 1000
+        ):
+        self._api_url = api_url
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._retries = retries
+        self._backoff = backoff
+        self._pool_size = pool_size
+        self._cache = UserCache(cache_ttl, cache_size)
+        self._subscribers: List[User] = []
+        self._subscribers_etag: Optional[str] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._pid: Optional[int] = None
+
+    async def get_user_by_tg_username(
+            self,
+            tg_username: str
+        ) -> Optional[User]:
+        """Получение пользователя по нику в телеге."""
+
+        found, user = self._cache.get(tg_username)
+        if found:
+            return user
+        user = await self._request('GET', f'/user/{tg_username}')
+        self._cache.set(tg_username, user)
+        return user
+
+    async def get_user(self, user_id: int) -> Optional[User]:
+        return await self._request('GET', f'/users/{user_id}')
+
+    async def get_subscribed_users(self) -> List[User]:
+        """Получение всех подписчиков бота.
+
+        Список загружается потоком NDJSON. Если с прошлой загрузки
+        пользователи не менялись, API отвечает 304 и возвращается
+        сохраненный список.
+        """
+
+        headers = {}
+        if self._subscribers_etag is not None:
+            headers['If-None-Match'] = self._subscribers_etag
+
+        async def read(response: aiohttp.ClientResponse) -> List[User]:
+            if response.status == 304:
+                return self._subscribers
+            users = [
+                json.loads(line)
+                async for line in response.content
+                if line.strip()
+            ]
+            self._subscribers = users
+            self._subscribers_etag = response.headers.get('ETag')
+            return users
+
+        return await self._request(
+            'GET', '/users',
+            read=read,
+            params={'subscribed': 'true', 'format': 'ndjson'},
+            headers=headers,
+            # Ограничивается ожидание данных, а не вся загрузка
+            timeout=aiohttp.ClientTimeout(sock_read=self._timeout.total)
+        ) or []
+
+    async def subscribe_user(
+            self,
+            tg_username: str,
+            chat_id: int
+        ) -> Optional[User]:
+        """Подписать пользователя на бота."""
+
+        self._cache.invalidate(tg_username)
+        return await self._request(
+            'POST', f'/subscriptions/{tg_username}', json={'chat_id': chat_id}
+        )
+
+    async def close(self):
+        if self._session is not None and self._pid == os.getpid():
+            await self._session.close()
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._session = aiohttp.ClientSession(
+                timeout=self._timeout,
+                connector=aiohttp.TCPConnector(limit=self._pool_size)
+            )
+        return self._session
+
+    async def _request(
+            self,
+            method: str,
+            path: str,
+            read: Optional[
+                Callable[[aiohttp.ClientResponse], Awaitable[Any]]
+            ] = None,
+            **kwargs
+        ) -> Any:
+        session = self._get_session()
+        for attempt in range(self._retries + 1):
+            try:
+                async with session.request(
+                    method, f'{self._api_url}{path}', **kwargs
+                ) as response:
+                    if response.status == 404:
+                        return None
+                    if response.status < 500:
+                        response.raise_for_status()
+                        if read is not None:
+                            return await read(response)
+                        return await response.json()
+                    error = f'статус {response.status}'
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                error = repr(e)
+
+            if attempt < self._retries:
+                logger.warning(
+                    f'Ошибка запроса {method} {path} '
+                    f'(попытка {attempt + 1}): {error}'
+                )
+                await asyncio.sleep(self._backoff * 2 ** attempt)
+
+        raise RuntimeError(f'API недоступно: {method} {path}: {error}')
+
+
+class LocalApiClient:
+    """Клиент с тем же интерфейсом, вызывающий app.crud напрямую.
+
+    Используется, когда бот развернут вместе с приложением и имеет
+    доступ к его базе данных: запросы выполняются в пуле потоков
+    event loop без HTTP.
+    """
+
+    def __init__(self):
+        from app import crud
+        from app.schemas import UserBase
+        from app.token_cache import token_cache
+        from app.users_version import users_version
+
+        self._crud = crud
+        self._schema = UserBase
+        self._token_cache = token_cache
+        self._users_version = users_version
+
+    async def get_user_by_tg_username(
+            self,
+            tg_username: str
+        ) -> Optional[User]:
+        return self._dump(await self._crud.offload(
+            self._crud.get_user_by_tg_username, tg_username
+        ))
+
+    async def get_user(self, user_id: int) -> Optional[User]:
+        return self._dump(await self._crud.offload(
+            lambda db: self._crud.get_user_info_by_id(user_id, db)
+        ))
+
+    async def get_subscribed_users(self) -> List[User]:
+        users = await self._crud.offload(self._crud.get_subscribed_users)
+        return [self._dump(user) for user in users]
+
+    async def subscribe_user(
+            self,
+            tg_username: str,
+            chat_id: int
+        ) -> Optional[User]:
+        user, old_token = await self._crud.offload(
+            self._subscribe, tg_username, chat_id
+        )
+        if user is not None:
+            await self._token_cache.invalidate(old_token)
+            await self._users_version.bump()
+        return user
+
+    async def close(self):
+        pass
+
+    def _subscribe(self, db, tg_username: str, chat_id: int):
+        user = self._crud.get_user_by_tg_username(db, tg_username)
+        if user is None:
+            return None, None
+        self._crud.subscribe_user_to_tgbot(db, user, chat_id)
+        return self._dump(user), user.auth_token
+
+    def _dump(self, user) -> Optional[User]:
+        if user is None:
+            return None
+        return self._schema.model_validate(user).model_dump()
+
+
+def create_api_client():
+    """Создание клиента API по переменной окружения API_MODE
+    (http - по умолчанию, local - прямые вызовы app.crud)."""
+
+    if os.getenv('API_MODE', 'http') == 'local':
+        return LocalApiClient()
+    return ApiClient(
+        os.getenv('API_URL', 'http://app:8000/api'),
+        timeout=float(os.getenv('API_TIMEOUT', 5)),
+        retries=int(os.getenv('API_RETRIES', 3)),
+        cache_ttl=float(os.getenv('API_USER_CACHE_TTL', 30))
+    )
@@ -1,8 +1,13 @@
-import asyncio
+import asyncio, os
 
 from celery import Celery
+from celery.signals import worker_init, worker_process_shutdown, worker_ready
 from datetime import timedelta
 
+from tg_bot.metrics import (mark_process_dead,
+                            prepare_multiprocess_dir,
+                            start_metrics_server)
+
 
 celery_app = Celery(
     'tg_bot',
@@ -12,14 +17,33 @@ celery_app = Celery(
 
 celery_app.autodiscover_tasks(['tg_bot'])
 
+# Уведомления отправляются по событиям (tg_bot.notifier), периодическая
+# проверка только подстраховывает на случай потерянных событий
 celery_app.conf.beat_schedule = {
     'check_messages': {
         'task': 'tasks.check_and_notify',
-        'schedule': timedelta(seconds=10),
+        'schedule': timedelta(
+            seconds=int(os.getenv('NOTIFY_RECONCILE_INTERVAL', 300))
+        ),
     }
 }
 
 
+@worker_init.connect
+def clear_metrics(**kwargs):
+    prepare_multiprocess_dir()
+
+
+@worker_ready.connect
+def serve_metrics(**kwargs):
+    start_metrics_server(int(os.getenv('CELERY_METRICS_PORT', 9808)))
+
+
+@worker_process_shutdown.connect
+def forget_process_metrics(pid=None, **kwargs):
+    mark_process_dead(pid or os.getpid())
+
+
 async def main():
     await celery_app.start()
 if __name__ == "__main__":
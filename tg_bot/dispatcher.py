@@ -0,0 +1,183 @@
+import asyncio, logging, os, threading, time
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramForbiddenError,
+    TelegramBadRequest,
+    TelegramRetryAfter,
+)
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ограничение частоты операций алгоритмом token bucket."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self._rate = rate
+        self._capacity = capacity or rate
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(
+                self._capacity,
+                self._tokens + (now - self._updated) * self._rate
+            )
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
+class NotificationDispatcher:
+    """Параллельная отправка сообщений в телеграм с учетом лимитов.
+
+    Общая частота отправки ограничена rate сообщений в секунду,
+    в один чат - не чаще раза в chat_interval секунд. При ответе 429
+    отправка приостанавливается на retry_after, сетевые и серверные
+    ошибки повторяются с экспоненциальной задержкой.
+    """
+
+    def __init__(
+            self,
+            bot: Bot,
+            rate: float = 30,
+            chat_interval: float = 1,
+            concurrency: int = 20,
+            max_retries: int = 5,
+            backoff: float = 0.5
+        ):
+        self._bot = bot
+        self._bucket = TokenBucket(rate)
+        self._chat_interval = chat_interval
+        self._chat_next: Dict[int, float] = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._paused_until = 0.0
+
+    async def send(self, chat_id: int, text: str) -> bool:
+        """Отправка сообщения, возвращает признак успеха."""
+
+        async with self._semaphore:
+            for attempt in range(self._max_retries + 1):
+                await self._wait_turn(chat_id)
+                try:
+                    await self._bot.send_message(chat_id=chat_id, text=text)
+                    return True
+                except TelegramRetryAfter as e:
+                    self._paused_until = max(
+                        self._paused_until,
+                        time.monotonic() + e.retry_after
+                    )
+                except (TelegramForbiddenError, TelegramBadRequest) as e:
+                    logger.warning(f'Сообщение в чат {chat_id} отклонено: {e}')
+                    return False
+                except Exception as e:
+                    logger.warning(
+                        f'Ошибка отправки в чат {chat_id} '
+                        f'(попытка {attempt + 1}): {e}'
+                    )
+                    await asyncio.sleep(self._backoff * 2 ** attempt)
+
+            logger.error(f'Сообщение в чат {chat_id} не отправлено')
+            return False
+
+    async def send_many(
+            self,
+            messages: Iterable[Tuple[int, str]]
+        ) -> List[bool]:
+        """Отправка пачки сообщений, возвращает признаки успеха
+        в порядке сообщений."""
+
+        return list(await asyncio.gather(
+            *(self.send(chat_id, text) for chat_id, text in messages)
+        ))
+
+    async def close(self):
+        await self._bot.session.close()
+
+    async def _wait_turn(self, chat_id: int):
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+
+        # Резервирование ближайшего свободного слота для чата
+        now = time.monotonic()
+        slot = max(now, self._chat_next.get(chat_id, now))
+        self._chat_next[chat_id] = slot + self._chat_interval
+        if len(self._chat_next) > 10000:
+            self._chat_next = {
+                chat: next_at
+                for chat, next_at in self._chat_next.items()
+                if next_at > now
+            }
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+        await self._bucket.acquire()
+
+
+def create_dispatcher(bot: Bot) -> NotificationDispatcher:
+    """Создание диспетчера с параметрами из окружения."""
+
+    return NotificationDispatcher(
+        bot,
+        rate=float(os.getenv('TG_RATE_LIMIT', 30)),
+        chat_interval=float(os.getenv('TG_CHAT_INTERVAL', 1)),
+        concurrency=int(os.getenv('TG_SEND_CONCURRENCY', 20)),
+        max_retries=int(os.getenv('TG_SEND_RETRIES', 5))
+    )
+
+
+class BackgroundLoop:
+    """Постоянный event loop в отдельном потоке процесса.
+
+    Синхронный код (задачи celery) выполняет корутины через run, при этом
+    сессия бота и состояние лимитов живут между вызовами. После fork
+    дочерний процесс создает собственный loop.
+    """
+
+    def __init__(self):
+        self._pid: Optional[int] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._dispatcher: Optional[NotificationDispatcher] = None
+        self._lock = threading.Lock()
+
+    @property
+    def dispatcher(self) -> NotificationDispatcher:
+        self._ensure_started()
+        return self._dispatcher
+
+    def run(self, coro, timeout: Optional[float] = None):
+        self._ensure_started()
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        return future.result(timeout)
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=self._loop.run_forever,
+                name='tg-dispatcher',
+                daemon=True
+            ).start()
+            self._dispatcher = asyncio.run_coroutine_threadsafe(
+                self._create_dispatcher(), self._loop
+            ).result()
+
+    async def _create_dispatcher(self) -> NotificationDispatcher:
+        # Семафор диспетчера должен создаваться внутри своего loop
+        return create_dispatcher(Bot(token=os.getenv('TELEGRAM_TOKEN')))
+
+
+background_loop = BackgroundLoop()
@@ -1,7 +1,12 @@
-import os, asyncio, aiohttp, logging
+import os, asyncio, logging
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
+from redis.asyncio import Redis
+
+from tg_bot.api_client import create_api_client
+from tg_bot.dispatcher import create_dispatcher
+from tg_bot.notifier import OfflineMessageNotifier
 
 
 logging.basicConfig(
@@ -10,31 +15,12 @@ logging.basicConfig(
 )
 
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
-API_URL = 'http://app:8000/api'
+REDIS_URL = os.getenv('REDIS_URL', 'redis://redis:6379/0')
+NOTIFY_DEBOUNCE = float(os.getenv('NOTIFY_DEBOUNCE', 0.5))
 
 bot = Bot(token=TELEGRAM_TOKEN)
 dp = Dispatcher()
-
-
-async def get_user_by_tg_username(tg_username):
-    """Получение пользователя по нику в телеге."""
-
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f'{API_URL}/user/{tg_username}') as response:
-            return await response.json()
-
-
-async def subscribe_user(tg_username, chat_id):
-    """Подписать пользователя на бота."""
-
-    async with aiohttp.ClientSession() as session:
-        data = {'chat_id': chat_id}
-        async with session.post(
-            f'{API_URL}/subscriptions/{tg_username}', json=data
-        ) as response:
-            if response.status == 404:
-                return
-            return await response.json()
+api = create_api_client()
 
 
 @dp.message(Command('start'))
@@ -43,19 +29,28 @@ async def say_hello(message: types.Message):
 
     tg_username = message.from_user.username
     chat_id = message.chat.id
-    user = await get_user_by_tg_username(tg_username)
+    user = await api.get_user_by_tg_username(tg_username)
 
     if user:
         await bot.send_message(chat_id, f'Привет, {user["username"]}!')
         if not user['is_subscribed_to_bot']:
-            await subscribe_user(tg_username, chat_id)
+            await api.subscribe_user(tg_username, chat_id)
             await bot.send_message(chat_id, 'Вы подписаны на уведомления.')
     else:
         await bot.send_message(chat_id, 'Пользователь не найден.')
 
 
 async def main():
-    await dp.start_polling(bot)
+    notifier = OfflineMessageNotifier(
+        Redis.from_url(REDIS_URL),
+        create_dispatcher(bot),
+        api,
+        debounce=NOTIFY_DEBOUNCE
+    )
+    try:
+        await asyncio.gather(dp.start_polling(bot), notifier.run())
+    finally:
+        await api.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,47 @@
+import os, shutil
+
+from prometheus_client import (CollectorRegistry,
+                               Counter,
+                               Histogram,
+                               REGISTRY,
+                               multiprocess,
+                               start_http_server)
+
+
+TASK_DURATION = Histogram(
+    'celery_task_duration_seconds',
+    'Время выполнения задач celery',
+    ['task']
+)
+NOTIFICATIONS = Counter(
+    'tg_notifications_total',
+    'Уведомления, отправленные в телеграм',
+    ['result']
+)
+
+
+def prepare_multiprocess_dir():
+    """Очистка каталога метрик воркеров от прошлого запуска.
+
+    В prefork каждый процесс пишет метрики в файлы каталога
+    PROMETHEUS_MULTIPROC_DIR, сервер метрик собирает их вместе.
+    """
+
+    path = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+
+
+def start_metrics_server(port: int):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    start_http_server(port, registry=registry)
+
+
+def mark_process_dead(pid: int):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(pid)
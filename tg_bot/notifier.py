@@ -0,0 +1,142 @@
+import asyncio, logging, socket
+
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+from typing import Dict, List
+
+from tg_bot.api_client import ApiClient
+from tg_bot.dispatcher import NotificationDispatcher
+from tg_bot.notify_state import create_state
+
+
+logger = logging.getLogger(__name__)
+
+EVENTS_STREAM = 'events:offline_messages'
+
+
+class OfflineMessageNotifier:
+    """Уведомления о недоставленных сообщениях по событиям приложения.
+
+    Приложение добавляет событие в поток events:offline_messages при каждой
+    постановке сообщения в очередь unsent_messages:{user_id}. Уведомитель
+    читает поток через группу потребителей, объединяет события одного
+    пользователя за интервал debounce и отправляет одно уведомление
+    с актуальным числом непрочитанных сообщений. Повторные уведомления
+    о том же числе сообщений, в том числе от периодической проверки
+    в celery, отсекаются общим состоянием NotificationState.
+    """
+
+    GROUP = 'tg_notifier'
+
+    def __init__(
+            self,
+            redis: Redis,
+            dispatcher: NotificationDispatcher,
+            api: ApiClient,
+            debounce: float = 0.5,
+            batch_size: int = 100
+        ):
+        self._redis = redis
+        self._dispatcher = dispatcher
+        self._state = create_state(redis)
+        self._api = api
+        self._debounce = debounce
+        self._batch_size = batch_size
+        self._consumer = socket.gethostname()
+        self._pending: Dict[int, List[bytes]] = {}
+        self._timers: Dict[int, asyncio.Task] = {}
+
+    async def run(self):
+        try:
+            await self._redis.xgroup_create(
+                EVENTS_STREAM, self.GROUP, id='$', mkstream=True
+            )
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+        await self._consume_pending()
+        while True:
+            response = await self._redis.xreadgroup(
+                self.GROUP,
+                self._consumer,
+                {EVENTS_STREAM: '>'},
+                count=self._batch_size,
+                block=5000
+            )
+            for _, entries in response:
+                await self._schedule_entries(entries)
+
+    async def _consume_pending(self):
+        """Обработка событий, полученных, но не подтвержденных
+        до перезапуска."""
+
+        last_id = '0'
+        while True:
+            response = await self._redis.xreadgroup(
+                self.GROUP,
+                self._consumer,
+                {EVENTS_STREAM: last_id},
+                count=self._batch_size
+            )
+            entries = response[0][1] if response else []
+            if not entries:
+                return
+            await self._schedule_entries(entries)
+            last_id = entries[-1][0]
+
+    async def _schedule_entries(self, entries):
+        for entry_id, fields in entries:
+            # Событие уже удалено из потока при обрезке по длине
+            if not fields:
+                await self._redis.xack(EVENTS_STREAM, self.GROUP, entry_id)
+                continue
+            self._schedule(int(fields[b'user_id']), entry_id)
+
+    def _schedule(self, user_id: int, entry_id: bytes):
+        self._pending.setdefault(user_id, []).append(entry_id)
+        if user_id not in self._timers:
+            self._timers[user_id] = asyncio.create_task(
+                self._notify_later(user_id)
+            )
+
+    async def _notify_later(self, user_id: int):
+        await asyncio.sleep(self._debounce)
+        del self._timers[user_id]
+        entry_ids = self._pending.pop(user_id, [])
+        try:
+            notified = await self._notify(user_id)
+        except Exception as e:
+            logger.error(f'Ошибка при отправке уведомления {user_id}: {e}')
+            notified = False
+
+        # При ошибке события не подтверждаются: они подтвердятся вместе
+        # со следующим успешным уведомлением пользователя или будут
+        # обработаны повторно после перезапуска. Снятая отметка claim
+        # позволяет отправить уведомление и периодической проверке
+        if notified:
+            await self._redis.xack(EVENTS_STREAM, self.GROUP, *entry_ids)
+        else:
+            self._pending.setdefault(user_id, [])[:0] = entry_ids
+
+    async def _notify(self, user_id: int) -> bool:
+        """Отправка уведомления, возвращает False при ошибке отправки."""
+
+        user = await self._api.get_user(user_id)
+        if not user or not user.get('is_subscribed_to_bot'):
+            return True
+
+        messages_count, = await self._state.claim([user_id])
+        if not messages_count:
+            return True
+
+        try:
+            sent = await self._dispatcher.send(
+                user['tg_chat_id'],
+                f'Непрочитанных сообщений: {messages_count}'
+            )
+        except Exception:
+            sent = False
+        if not sent:
+            await self._state.release({user_id: messages_count})
+        return sent
@@ -0,0 +1,92 @@
+import os
+
+from typing import Dict, Iterable, List
+
+
+# Для каждой пары ключей (очередь пользователя, последнее уведомление)
+# возвращает длину очереди, если о ней еще не уведомляли, иначе 0.
+# Пустая очередь сбрасывает состояние, чтобы следующее сообщение
+# снова вызвало уведомление.
+CLAIM_SCRIPT = '''
+local ttl = tonumber(ARGV[1])
+local result = {}
+for i = 1, #KEYS, 2 do
+    local count = redis.call('LLEN', KEYS[i])
+    local notified = tonumber(redis.call('GET', KEYS[i + 1]) or '0')
+    if count == 0 then
+        redis.call('DEL', KEYS[i + 1])
+        result[#result + 1] = 0
+    elseif count ~= notified then
+        redis.call('SET', KEYS[i + 1], count, 'EX', ttl)
+        result[#result + 1] = count
+    else
+        result[#result + 1] = 0
+    end
+end
+return result
+'''
+
+# Отмена отметки об уведомлении, если она не изменилась с момента claim
+RELEASE_SCRIPT = '''
+for i = 1, #KEYS do
+    if redis.call('GET', KEYS[i]) == ARGV[i] then
+        redis.call('DEL', KEYS[i])
+    end
+end
+return 0
+'''
+
+
+class NotificationState:
+    """Общее для всех процессов состояние отправленных уведомлений.
+
+    Число сообщений, о котором пользователь уже уведомлен, хранится
+    в ключе notify_last:{user_id} со сроком жизни ttl. Проверка очереди
+    и обновление состояния выполняются одним скриптом, поэтому
+    уведомление об одном и том же числе сообщений отправляет только
+    один процесс. Работает как с синхронным, так и с асинхронным
+    клиентом Redis: для асинхронного результат claim нужно дождаться.
+    """
+
+    def __init__(self, redis, ttl: int = 86400, batch_size: int = 500):
+        self._ttl = ttl
+        self._batch_size = batch_size
+        self._claim = redis.register_script(CLAIM_SCRIPT)
+        self._release = redis.register_script(RELEASE_SCRIPT)
+
+    def claim(self, user_ids: Iterable[int]):
+        """Число сообщений для уведомления по каждому пользователю
+        (0 - уведомлять не нужно)."""
+
+        keys = []
+        for user_id in user_ids:
+            keys.append(f'unsent_messages:{user_id}')
+            keys.append(f'notify_last:{user_id}')
+        return self._claim(keys=keys, args=[self._ttl])
+
+    def release(self, counts: Dict[int, int]):
+        """Отмена claim для неотправленных уведомлений: следующая
+        проверка снова вернет число сообщений пользователя."""
+
+        return self._release(
+            keys=[f'notify_last:{user_id}' for user_id in counts],
+            args=list(counts.values())
+        )
+
+    def batches(self, user_ids: List[int]) -> Iterable[List[int]]:
+        for start in range(0, len(user_ids), self._batch_size):
+            yield user_ids[start:start + self._batch_size]
+
+    @staticmethod
+    def pending(user_ids: List[int], counts: List[int]) -> Dict[int, int]:
+        return {
+            user_id: count
+            for user_id, count in zip(user_ids, counts)
+            if count
+        }
+
+
+def create_state(redis) -> NotificationState:
+    return NotificationState(
+        redis, ttl=int(os.getenv('NOTIFY_STATE_TTL', 86400))
+    )
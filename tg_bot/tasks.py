@@ -1,21 +1,18 @@
-import asyncio, requests
+import logging
 
 from redis import Redis
 
+from tg_bot.api_client import create_api_client
 from tg_bot.celery_config import celery_app
+from tg_bot.dispatcher import background_loop
+from tg_bot.metrics import NOTIFICATIONS, TASK_DURATION
+from tg_bot.notify_state import create_state
 
 
-API_URL = 'http://app:8000/api'
+logger = logging.getLogger(__name__)
 redis_client = Redis(host='redis', port=6379, db=0)
-
-last_message_count = {}
-
-
-def get_subscribed_users():
-    """Получение списка подписанных на бота пользователей."""
-
-    response = requests.get(f'{API_URL}/users?subscribed=true')
-    return response.json()
+notify_state = create_state(redis_client)
+api = create_api_client()
 
 
 @celery_app.task
@@ -23,32 +20,52 @@ def check_and_notify():
     """Проверка наличия в Redis недоставленных сообщений
     и отправка уведомления в бот."""
 
-    from tg_bot.main import bot
-
-    subscribed_users = get_subscribed_users()
-
-    for user in subscribed_users:
-        messages_key = f'unsent_messages:{user["id"]}'
-        messages_count = redis_client.llen(messages_key)
-
-        # Запись значения, если оно отсутствует
-        if user['id'] not in last_message_count:
-            last_message_count[user['id']] = messages_count
-
-        # Проверка, изменилось ли количество сообщений
-        if (
-            messages_count > 0 and
-            messages_count != last_message_count[user['id']]
-        ):
-            last_message_count[user['id']] = messages_count
-            try:
-                loop = asyncio.get_event_loop()
-                loop.run_until_complete(bot.send_message(
-                    chat_id=user['tg_chat_id'],
-                    text=f'Непрочитанных сообщений: {messages_count}'
-                ))
-
-                # Обновление количества сообщений после отправки уведомления
-                last_message_count[user['id']] = messages_count
-            except Exception as e:
-                print(f'Ошибка при отправке сообщения: {e}')
+    with TASK_DURATION.labels('check_and_notify').time():
+        _check_and_notify()
+
+
+def _check_and_notify():
+    subscribed_users = {
+        user['id']: user
+        for user in background_loop.run(api.get_subscribed_users())
+    }
+
+    claims = {}
+    for user_ids in notify_state.batches(list(subscribed_users)):
+        counts = notify_state.claim(user_ids)
+        claims.update(notify_state.pending(user_ids, counts))
+
+    if not claims:
+        return
+
+    # Неотправленные уведомления повторятся при следующей проверке
+    try:
+        results = background_loop.run(
+            background_loop.dispatcher.send_many(
+                (
+                    subscribed_users[user_id]['tg_chat_id'],
+                    f'Непрочитанных сообщений: {messages_count}'
+                )
+                for user_id, messages_count in claims.items()
+            )
+        )
+    except Exception:
+        notify_state.release(claims)
+        raise
+
+    unsent = {
+        user_id: messages_count
+        for (user_id, messages_count), ok in zip(claims.items(), results)
+        if not ok
+    }
+    if unsent:
+        notify_state.release(unsent)
+
+    sent = len(results) - len(unsent)
+    failed = len(unsent)
+    NOTIFICATIONS.labels('sent').inc(sent)
+    NOTIFICATIONS.labels('failed').inc(failed)
+    if failed:
+        logger.warning(
+            'Не отправлено уведомлений: %d из %d', failed, sent + failed
+        )